@@ -8,7 +8,90 @@ ENV_PATH = os.path.join(BASE_DIR, ".env")
 class Settings(BaseSettings):
     MONGODB_URL: str
     DB_NAME: str
-    GEMINI_API_KEY: str
+    GEMINI_API_KEY: str = ""                # only needed with GRADING_BACKEND=gemini
+    GEMINI_MODEL: str = "gemini-flash-latest"
+
+    # Grading backend: "gemini" or "mock" (offline, deterministic; for load tests and benchmarks)
+    GRADING_BACKEND: str = "gemini"
+    MOCK_SEED: int = 42
+    MOCK_LATENCY_MEDIAN_MS: float = 1500.0
+    MOCK_LATENCY_SIGMA: float = 0.5         # log-normal spread of mock latency
+    MOCK_ERROR_RATE: float = 0.0            # fraction of calls failing with a 503
+    MOCK_RATE_LIMIT_RATE: float = 0.0       # fraction of calls failing with a 429
+    MOCK_MALFORMED_RATE: float = 0.0        # fraction of responses with broken JSON
+
+    # Sessions (user_session cookie is signed with SESSION_SECRET)
+    SESSION_SECRET: str = ""                # required; startup fails when missing or left as the placeholder
+    SESSION_DEV_RANDOM_SECRET: bool = False # local development only: random per-process key instead
+    SESSION_MAX_AGE_SECONDS: int = 12 * 3600
+    USER_CACHE_TTL_SECONDS: float = 60.0    # bounds staleness of roles/enrollments across processes
+    USER_CACHE_MAX_ENTRIES: int = 10000
+
+    # Password hashing (runs in a thread pool, off the event loop)
+    BCRYPT_ROUNDS: int = 12                 # cost factor for new hashes; older hashes are upgraded on login
+    PASSWORD_HASH_WORKERS: int = 4
+
+    # Grading queue (grading_jobs collection)
+    GRADING_WORKERS: int = 16               # concurrent grading workers per process
+    GRADING_LEASE_SECONDS: int = 120        # visibility timeout of a claimed job
+    GRADING_MAX_ATTEMPTS: int = 5           # attempts before a job is marked failed
+    GRADING_POLL_INTERVAL: float = 2.0      # idle worker poll interval (seconds)
+    GRADING_WORKERS_IN_WEB: bool = True     # set false when grading runs in separate `python -m app.worker` processes
+    GRADING_QUEUE_CHANGE_STREAM: bool = False  # wake workers on new jobs from other processes (needs a replica set)
+
+    # Cross-submission batching of Gemini calls (0 window disables coalescing)
+    GRADING_BATCH_WINDOW_MS: int = 300      # how long to collect answers before calling the model
+    GRADING_BATCH_MAX_TOKENS: int = 12000   # flush early once the estimated prompt reaches this size
+    GRADING_BATCH_MAX_ITEMS: int = 40       # flush early once this many answers are pending
+
+    # Per-call token budgets used to split large batches (e.g. long essay exams)
+    GRADING_MAX_INPUT_TOKENS_PER_CALL: int = 32000
+    GRADING_MAX_OUTPUT_TOKENS_PER_CALL: int = 6000  # keep below GEMINI_MAX_OUTPUT_TOKENS so responses are not cut off
+    GRADING_OUTPUT_TOKENS_PER_ITEM: int = 300       # response size per answer until an exam has statistics
+    GEMINI_MAX_OUTPUT_TOKENS: int = 8192
+
+    # Grading result cache (in-process LRU + grading_cache collection)
+    GRADING_CACHE_ENABLED: bool = True
+    GRADING_CACHE_TTL_SECONDS: int = 7 * 24 * 3600
+    GRADING_CACHE_MAX_ENTRIES: int = 10000  # in-process LRU size
+
+    # Gemini quota shaping (shared by all grading paths)
+    GEMINI_RPM: int = 60                    # requests per minute
+    GEMINI_TPM: int = 1000000               # tokens per minute
+    GEMINI_QUOTA_SHARE: float = 1.0         # fraction of RPM/TPM this process may use (limits are per process)
+    GEMINI_INITIAL_CONCURRENCY: int = 5
+    GEMINI_MIN_CONCURRENCY: int = 1
+    GEMINI_MAX_CONCURRENCY: int = 16
+    GEMINI_TARGET_LATENCY_SECONDS: float = 30.0  # concurrency only grows while calls are faster than this
+    GEMINI_MAX_ATTEMPTS: int = 3
+    GEMINI_BACKOFF_BASE_SECONDS: float = 1.0
+    GEMINI_BACKOFF_MAX_SECONDS: float = 30.0
+
+    # Exam prompt templates and Gemini context caching of the shared exam prefix
+    PROMPT_TEMPLATE_CACHE_MAX_ENTRIES: int = 256
+    GEMINI_CONTEXT_CACHE_ENABLED: bool = True
+    GEMINI_CONTEXT_CACHE_TTL_SECONDS: int = 3600
+    GEMINI_CONTEXT_CACHE_MIN_TOKENS: int = 1024  # smaller prefixes are sent inline (below the API minimum)
+
+    # Exam documents cache (edits bump the exam `version`; TTL bounds staleness across processes)
+    EXAM_CACHE_TTL_SECONDS: float = 30.0
+    EXAM_CACHE_MAX_ENTRIES: int = 1000
+
+    # Submission status push (SSE) and polling fallback
+    SSE_HEARTBEAT_SECONDS: float = 15.0
+    STATUS_CACHE_TTL_SECONDS: float = 2.0
+    STATUS_CACHE_MAX_ENTRIES: int = 10000
+    SUBMISSION_CHANGE_STREAM: bool = False  # relay status changes from other processes (needs a replica set)
+
+    # Buffered writer for ai_logs / audit_logs
+    LOG_FLUSH_INTERVAL_SECONDS: float = 1.0
+    LOG_FLUSH_BATCH_SIZE: int = 200         # flush early once this many entries are waiting
+    LOG_BUFFER_MAX_ENTRIES: int = 10000     # routine entries are sampled past half of this and dropped when full
+    LOG_SAMPLE_RATE: float = 0.1
+
+    # Prometheus-style metrics
+    METRICS_ENABLED: bool = True            # expose GET /metrics on the web server
+    WORKER_METRICS_PORT: int = 0            # serve /metrics from `python -m app.worker` on this port (0 = off)
 
     class Config:
         env_file = ENV_PATH
@@ -1,6 +1,57 @@
+import asyncio
 import certifi
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
 from app.config import settings
+from app.services.metrics import mongo_command_metrics
+
+# Command latency for /metrics; applies to every client created below
+monitoring.register(mongo_command_metrics)
+
+# Declarative index registry: collection -> [(keys, options)]
+# Ensured idempotently at startup by Database.ensure_indexes
+INDEXES = {
+    "users": [
+        ([("username", 1)], {"unique": True}),
+        ([("role", 1), ("enrolled_subjects", 1)], {}),
+    ],
+    "submissions": [
+        ([("exam_id", 1), ("submitted_at", -1)], {}),
+        ([("student_username", 1), ("submitted_at", -1)], {}),
+    ],
+    "exams": [
+        ([("created_by", 1), ("is_deleted", 1)], {}),
+        ([("is_deleted", 1), ("subject", 1)], {}),
+    ],
+    "audit_logs": [
+        ([("timestamp", -1)], {}),
+    ],
+    "ai_logs": [
+        ([("timestamp", -1)], {}),
+    ],
+    "grading_jobs": [
+        ([("status", 1), ("available_at", 1)], {}),
+        ([("status", 1), ("lease_expires_at", 1)], {}),
+        ([("submission_id", 1), ("status", 1)], {}),
+        # At most one pending job per submission, even when two requests enqueue at the same time
+        ([("submission_id", 1)], {
+            "unique": True,
+            "name": "submission_id_pending_unique",
+            "partialFilterExpression": {"status": {"$in": ["queued", "running"]}}
+        }),
+        ([("context.bulk_id", 1), ("status", 1)], {}),
+    ],
+    "regrade_runs": [
+        ([("exam_id", 1), ("created_at", -1)], {}),
+    ],
+    "stats": [
+        ([("kind", 1), ("exam_id", 1)], {}),
+    ],
+    "grading_cache": [
+        ([("expires_at", 1)], {"expireAfterSeconds": 0}),
+        ([("exam_id", 1), ("question_id", 1)], {}),
+    ],
+}
 
 class Database:
     client: AsyncIOMotorClient = None
@@ -57,6 +108,17 @@ class Database:
                         print(f"❌ All connection attempts failed: {e3}")
             return False
 
+    async def ensure_indexes(self):
+        """Creates every index in INDEXES; existing ones are left untouched."""
+        for collection, indexes in INDEXES.items():
+            for keys, options in indexes:
+                try:
+                    await asyncio.wait_for(self.db[collection].create_index(keys, **options), timeout=30.0)
+                except Exception as e:
+                    # e.g. duplicate usernames block the unique index; see scripts/check_duplicates.py
+                    print(f"⚠️ Could not create index {keys} on {collection}: {e}")
+        print("Ensured database indexes.")
+
     def disconnect(self):
         if self.client:
             self.client.close()
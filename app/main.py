@@ -1,25 +1,36 @@
 from fastapi import FastAPI, Request, Form, Depends, HTTPException, BackgroundTasks
-from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
-import io
-import csv
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, PlainTextResponse
+import json
+import time
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from contextlib import asynccontextmanager
 import os
 from datetime import datetime
 from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 import sys
 import os
 # Add project root to sys.path to allow 'app' module import
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app.database import db
-from app.models import UserModel
-from app.services.ai_service import ai_service
+from app.models import UserModel, SubmissionSummaryModel
+from app.services.grading_queue import grading_queue
+from app.services.grading_cache import grading_cache
+from app.services.prompt_templates import compile_exam_prompt, question_version, current_question_version
+from app.services.log_sink import log_sink
+from app.services.regrade_service import regrade_service
+from app.services.exam_service import question_index, exam_cache
+from app.services.export_service import EXPORT_FORMATS, export_header, iter_result_rows, content_disposition
+from app.services.metrics import registry as metrics_registry, http_request_duration, loop_lag_monitor
+from app.services.events import submission_events, FINAL_STATUSES
+from app.services.grading_service import FAILED_STATUSES
+from app.services.stats_service import stats_service, stats_snapshot, STATS_FIELDS
+from app.services.auth_service import create_session_token, read_session_token, user_cache, hash_password, verify_password, password_needs_rehash
+from app.config import settings
 import asyncio
-from passlib.context import CryptContext
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -31,19 +42,32 @@ async def lifespan(app: FastAPI):
     if not connected:
         print("CRITICAL: Failed to establish a database connection.")
         # We continue to allow the app to start, but operations will fail
+    else:
+        await db.ensure_indexes()
+        try:
+            # One-time migration: fill the stats collection from existing submissions
+            await stats_service.ensure_built()
+        except Exception as e:
+            print(f"Stats build failed (run scripts/rebuild_stats.py): {e}")
     
     # Seed Test Data - Wrapped in try-except to prevent hang if DB is unreachable
     try:
         print("Starting database seeding...")
         users_collection = db.db["users"]
         test_users = [
-            {"username": "student1", "password": pwd_context.hash("password"), "role": "student"},
-            {"username": "teacher1", "password": pwd_context.hash("password"), "role": "teacher"}
+            {"username": "student1", "password": "password", "role": "student"},
+            {"username": "teacher1", "password": "password", "role": "teacher"}
         ]
         for user_data in test_users:
+            # Skip re-hashing when the stored hash already matches the seed password
+            existing = await asyncio.wait_for(users_collection.find_one(
+                {"username": user_data["username"], "role": user_data["role"]}, {"password": 1}
+            ), timeout=5.0)
+            if existing and existing.get("password") and await verify_password(user_data["password"], existing["password"]):
+                continue
             await asyncio.wait_for(users_collection.update_one(
                 {"username": user_data["username"], "role": user_data["role"]},
-                {"$set": user_data},
+                {"$set": {**user_data, "password": await hash_password(user_data["password"])}},
                 upsert=True
             ), timeout=5.0)
         print("Ensured test users exist.")
@@ -73,12 +97,46 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         print(f"CRITICAL: ไม่สามารถเริ่มระบบฐานข้อมูลได้: {e}")
 
+    # Start grading workers (pending jobs from a previous run are resumed),
+    # unless grading runs in separate `python -m app.worker` processes
+    if settings.GRADING_WORKERS_IN_WEB:
+        grading_queue.start()
+    else:
+        print("Grading workers disabled in the web process (GRADING_WORKERS_IN_WEB=false); run `python -m app.worker`.")
+    submission_events.start()
+    loop_lag_monitor.start()
+    log_sink.start()
+
     yield
-    # Shutdown: Disconnect DB
+    # Shutdown: Stop workers, then disconnect DB
+    await grading_queue.stop()
+    await submission_events.stop()
+    await loop_lag_monitor.stop()
+    # Flush buffered ai_logs / audit_logs before the connection closes
+    await log_sink.stop()
     db.disconnect()
 
 app = FastAPI(title="Subjective Exam Grading AI", lifespan=lifespan)
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Label by route template (/exam/{exam_id}) so ids do not explode the series count
+        route = request.scope.get("route")
+        if route is not None:
+            path = route.path
+        elif request.url.path.startswith("/static/"):
+            path = "/static"
+        else:
+            path = "unmatched"
+        http_request_duration.observe(time.perf_counter() - started, method=request.method, route=path, status=status)
+
 # Get current directory
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -95,16 +153,14 @@ async def get_current_user(request: Request):
     if not user_cookie:
         raise HTTPException(status_code=303, detail="Not authenticated", headers={"Location": "/login"})
     
-    # Securely verify user and role from database (Server-side check)
-    user_cookie = user_cookie.strip()
-    user = await db.db["users"].find_one({"username": user_cookie})
+    # Verify the signed session, then resolve the user through the in-process cache
+    username = read_session_token(user_cookie.strip())
+    if not username:
+        raise HTTPException(status_code=303, detail="Invalid session", headers={"Location": "/login"})
+    user = await user_cache.get(username)
     if not user:
         raise HTTPException(status_code=303, detail="User not found", headers={"Location": "/login"})
-    return {
-        "username": user["username"], 
-        "role": user.get("role", "student"),
-        "enrolled_subjects": user.get("enrolled_subjects", [])
-    }
+    return user
 
 def teacher_only(user: dict = Depends(get_current_user)):
     if user["role"] != "teacher":
@@ -134,20 +190,27 @@ async def login_submit(request: Request, username: str = Form(...), password: st
     # Find user by username only
     user = await user_collection.find_one({"username": username})
     
-    if user and pwd_context.verify(password, user["password"]):
+    if user and await verify_password(password, user["password"]):
+        # Upgrade hashes made with an older cost factor
+        if password_needs_rehash(user["password"]):
+            await user_collection.update_one({"_id": user["_id"]}, {"$set": {"password": await hash_password(password)}})
+
         # Success: Redirect based on role in database
         role = user.get("role", "student")
         target = "/student/dashboard" if role == "student" else "/teacher/dashboard" 
         response = RedirectResponse(url=target, status_code=303)
-        response.set_cookie(key="user_session", value=username)
+        response.set_cookie(
+            key="user_session",
+            value=create_session_token(username),
+            max_age=settings.SESSION_MAX_AGE_SECONDS,
+            httponly=True,
+            samesite="lax"
+        )
         return response
     
     # Failure: Show error
-    role_name = " (นักเรียน)" if role == "student" else " (ผู้สอน)"
     return templates.TemplateResponse("login.html", {
         "request": request, 
-        "role": role, 
-        "role_name": role_name,
         "error": "Invalid username or password"
     })
 
@@ -165,23 +228,30 @@ async def register_page(request: Request):
 async def register_submit(request: Request, username: str = Form(...), password: str = Form(...)):
     user_collection = db.db["users"]
     
-    # Check if user already exists
-    existing_user = await user_collection.find_one({"username": username})
-    if existing_user:
+    def username_taken():
         return templates.TemplateResponse("register.html", {
             "request": request,
             "error": "ชื่อผู้ใช้นี้ถูกใช้งานแล้ว กรุณาเลือกชื่ออื่น"
         })
+
+    # Check if user already exists
+    existing_user = await user_collection.find_one({"username": username})
+    if existing_user:
+        return username_taken()
     
     # Create new student user with empty enrollment list
     new_user = {
         "username": username,
-        "password": pwd_context.hash(password),
+        "password": await hash_password(password),
         "role": "student",
         "enrolled_subjects": []
     }
     
-    await user_collection.insert_one(new_user)
+    try:
+        await user_collection.insert_one(new_user)
+    except DuplicateKeyError:
+        # Registered concurrently while the password was being hashed (unique username index)
+        return username_taken()
     
     # Redirect to login with success message possibly? For now just simple redirect
     return RedirectResponse(url="/login", status_code=303)
@@ -192,32 +262,44 @@ async def teacher_dashboard(request: Request, user: dict = Depends(teacher_only)
     exams_cursor = db.db["exams"].find({
         "created_by": user["username"],
         "is_deleted": {"$ne": True}
-    })
+    }, {"subject": 1, "title": 1, "description": 1, "questions.id": 1})
     exams = await exams_cursor.to_list(100)
     for ex in exams:
         ex["id"] = str(ex["_id"])
     
     # Filter submissions that belong to this teacher's exams
     exam_ids = [str(ex["_id"]) for ex in exams]
-    submissions_cursor = db.db["submissions"].find({"exam_id": {"$in": exam_ids}}).sort("submitted_at", -1)
-    all_submissions = await submissions_cursor.to_list(1000)
     
-    # Calculate Stats
-    total_exams = len(exams)
-    total_subs = len(all_submissions)
+    # Calculate Stats server-side in one aggregation (no cap on the number of submissions)
+    score_expr = {"$ifNull": ["$teacher_total_score", {"$ifNull": ["$total_score", 0]}]}
+    graded_match = {"$match": {"status": {"$in": ["graded", "reviewed"]}}}
+    pipeline = [
+        {"$match": {"exam_id": {"$in": exam_ids}}},
+        {"$sort": {"submitted_at": -1}},
+        {"$facet": {
+            "counts": [{"$count": "total"}],
+            # Average score across all graded/reviewed submissions
+            "graded": [graded_match, {"$group": {"_id": None, "avg": {"$avg": score_expr}}}],
+            # Score Distribution for Charts
+            "distribution": [graded_match, {"$bucket": {
+                "groupBy": score_expr,
+                "boundaries": [float("-inf"), 5, 8, float("inf")],
+                "default": "other",
+                "output": {"count": {"$sum": 1}}
+            }}],
+            "recent": [{"$limit": 10}, {"$project": SubmissionSummaryModel.projection()}]
+        }}
+    ]
+    facets = (await db.db["submissions"].aggregate(pipeline).to_list(1))[0]
     
-    # Average score across all graded/reviewed submissions
-    graded_subs = [s for s in all_submissions if s.get("status") in ["graded", "reviewed"]]
-    total_score_sum = sum(s.get("teacher_total_score", s.get("total_score", 0)) for s in graded_subs)
-    avg_score = round(total_score_sum / len(graded_subs), 2) if graded_subs else 0
+    total_exams = len(exams)
+    total_subs = facets["counts"][0]["total"] if facets["counts"] else 0
+    avg_score = round(facets["graded"][0]["avg"] or 0, 2) if facets["graded"] else 0
     
-    # Calculate Score Distribution for Charts
+    bucket_names = {5: "Mid (5-7)", 8: "High (8-10)"}
     distribution = {"High (8-10)": 0, "Mid (5-7)": 0, "Low (0-4)": 0}
-    for s in graded_subs:
-        score = s.get("teacher_total_score", s.get("total_score", 0))
-        if score >= 8: distribution["High (8-10)"] += 1
-        elif score >= 5: distribution["Mid (5-7)"] += 1
-        else: distribution["Low (0-4)"] += 1
+    for bucket in facets["distribution"]:
+        distribution[bucket_names.get(bucket["_id"], "Low (0-4)")] += bucket["count"]
         
     # Get Unique Subjects for Filter
     subjects = sorted(list(set(ex.get("subject") for ex in exams if ex.get("subject"))))
@@ -227,10 +309,10 @@ async def teacher_dashboard(request: Request, user: dict = Depends(teacher_only)
     enrolled_students_cursor = db.db["users"].find({
         "role": "student",
         "enrolled_subjects": {"$in": subjects}
-    })
+    }, {"username": 1})
     enrolled_students = await enrolled_students_cursor.to_list(1000)
         
-    recent_submissions = all_submissions[:10]
+    recent_submissions = facets["recent"]
     for sub in recent_submissions:
         sub["id"] = str(sub["_id"])
     
@@ -249,6 +331,13 @@ async def teacher_dashboard(request: Request, user: dict = Depends(teacher_only)
         }
     })
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus text exposition of request, grading, Gemini, MongoDB and event-loop metrics."""
+    if not settings.METRICS_ENABLED:
+        raise HTTPException(status_code=404)
+    return PlainTextResponse(await metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/test_server_reload")
 async def test_reload():
     return {"status": "ok", "message": "The server has successfully reloaded!"}
@@ -259,7 +348,8 @@ async def dump_user_route(request: Request):
     if not user_cookie:
         return {"error": "no cookie"}
     db_name = db.db.name
-    user = await db.db["users"].find_one({"username": user_cookie.strip()})
+    username = read_session_token(user_cookie.strip())
+    user = await db.db["users"].find_one({"username": username}) if username else None
     return {
         "cookie": user_cookie,
         "db": db_name,
@@ -337,6 +427,7 @@ async def enroll_subject(request: Request, subject: str = Form(...), user: dict
         {"username": user["username"]},
         {"$addToSet": {"enrolled_subjects": subject}}
     )
+    user_cache.invalidate(user["username"])
     
     return RedirectResponse(url="/student/dashboard", status_code=303)
 
@@ -350,16 +441,14 @@ async def unenroll_subject(request: Request, subject: str = Form(...), user: dic
         {"username": user["username"]},
         {"$pull": {"enrolled_subjects": subject}}
     )
+    user_cache.invalidate(user["username"])
     
     return RedirectResponse(url="/student/dashboard", status_code=303)
 
 @app.get("/exam/{exam_id}", response_class=HTMLResponse)
 async def take_exam(request: Request, exam_id: str, user: dict = Depends(get_current_user)):
-    exam = await db.db["exams"].find_one({
-        "_id": ObjectId(exam_id),
-        "is_deleted": {"$ne": True}
-    })
-    if not exam:
+    exam = await exam_cache.get(exam_id)
+    if not exam or exam.get("is_deleted"):
         return HTMLResponse("Exam not found or has been deleted", status_code=404)
         
     exam["id"] = str(exam["_id"])
@@ -371,17 +460,57 @@ async def waiting_page(request: Request, submission_id: str):
 
 @app.get("/api/submission/status/{submission_id}")
 async def get_submission_status(submission_id: str):
-    submission = await db.db["submissions"].find_one({"_id": ObjectId(submission_id)})
-    if not submission:
+    # Polling fallback for clients without SSE: cached, status-only read
+    status = await submission_events.get_status(submission_id) if ObjectId.is_valid(submission_id) else None
+    if status is None:
         return {"status": "not_found"}
-    return {"status": submission.get("status", "submitted")}
+    return {"status": status}
+
+@app.get("/api/submission/events/{submission_id}")
+async def submission_status_events(request: Request, submission_id: str):
+    """Server-Sent Events stream that pushes the submission status until grading finishes."""
+    # Checked before the stream starts so unknown ids get a plain 404 instead of a broken stream
+    initial = await submission_events.get_status(submission_id) if ObjectId.is_valid(submission_id) else None
+    if initial is None:
+        raise HTTPException(status_code=404, detail="Submission not found")
+
+    async def event_stream():
+        queue = submission_events.subscribe(submission_id)
+        try:
+            status = initial
+            yield f"data: {json.dumps({'status': status})}\n\n"
+            while status not in FINAL_STATUSES:
+                try:
+                    status = await asyncio.wait_for(queue.get(), timeout=submission_events.recheck_interval)
+                    yield f"data: {json.dumps({'status': status})}\n\n"
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    # Catch changes made by a process we receive no events from
+                    latest = await submission_events.get_status(submission_id)
+                    if latest is None:
+                        yield f"data: {json.dumps({'status': 'not_found'})}\n\n"
+                        return
+                    if latest != status:
+                        status = latest
+                        yield f"data: {json.dumps({'status': status})}\n\n"
+                    else:
+                        yield ": keep-alive\n\n"
+        finally:
+            submission_events.unsubscribe(submission_id, queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @app.post("/exam/{exam_id}/submit")
 async def submit_exam(request: Request, exam_id: str, user: dict = Depends(get_current_user)):
         
     form_data = await request.form()
     
-    exam = await db.db["exams"].find_one({"_id": ObjectId(exam_id)})
+    exam = await exam_cache.get(exam_id)
     if not exam:
         return HTMLResponse("Exam not found", status_code=404)
 
@@ -409,81 +538,46 @@ async def submit_exam(request: Request, exam_id: str, user: dict = Depends(get_c
     }
     
     submission_id = (await db.db["submissions"].insert_one(submission)).inserted_id
+    await stats_service.record_change(None, submission)
     
-    # Trigger AI Grading in Background
-    async def process_grading(sid, exam_obj, answers_list):
-        batch_data = []
-        for ans in answers_list:
-            q_id = ans["question_id"]
-            original_q = next((q for q in exam_obj["questions"] if q["id"] == q_id), None)
-            if original_q:
-                batch_data.append({
-                    "question_text": original_q["text"],
-                    "student_answer": ans["answer_text"],
-                    "max_score": original_q["max_score"],
-                    "answer_key": original_q.get("answer_key"),
-                    "rubric": original_q.get("rubric")
-                })
-        
-        if batch_data:
-            results = await ai_service.grade_batch(batch_data, context={"student": user["username"], "exam": exam.get("title")})
-            
-            total_score = 0
-            res_idx = 0
-            for ans in answers_list:
-                original_q = next((q for q in exam_obj["questions"] if q["id"] == ans["question_id"]), None)
-                if original_q and res_idx < len(results):
-                    res = results[res_idx]
-                    ans.update({
-                        "score": res.get("score", 0),
-                        "justification": res.get("justification"),
-                        "feedback": res.get("feedback"),
-                        "strengths": res.get("strengths"),
-                        "improvements": res.get("improvements")
-                    })
-                    total_score += res.get("score", 0)
-                    res_idx += 1
-            
-            await db.db["submissions"].update_one(
-                {"_id": sid},
-                {"$set": {
-                    "answers": answers_list,
-                    "total_score": total_score,
-                    "status": "graded"
-                }}
-            )
-
-    # Fire and forget (in a real production app, use Celery/BackgroundTasks)
-    asyncio.create_task(process_grading(submission_id, exam, answers))
+    # Queue AI grading durably; workers pick it up even if this process restarts
+    await grading_queue.enqueue(submission_id, action="grade", context={"student": user["username"], "exam": exam.get("title")})
     
     return RedirectResponse(url=f"/exam/waiting/{submission_id}", status_code=303)
 
 @app.get("/results", response_class=HTMLResponse)
 async def view_results(request: Request, user: dict = Depends(get_current_user)):
         
-    submissions = await db.db["submissions"].find({"student_username": user["username"]}).sort("submitted_at", -1).to_list(100)
+    # The page shows AI feedback per answer, but never the answer texts themselves
+    submissions = await db.db["submissions"].find(
+        {"student_username": user["username"]},
+        {"answers.answer_text": 0, "answers.grading_error_message": 0, "answers.question_version": 0, "failed_items": 0}
+    ).sort("submitted_at", -1).to_list(100)
     
-    # Pre-fetch all relevant exams to avoid multiple DB calls in a loop
+    # Pre-fetch all relevant exams to avoid multiple DB calls in a loop (questions only, for enrichment)
     exam_ids = list(set(sub["exam_id"] for sub in submissions if "exam_id" in sub))
-    exams_cursor = db.db["exams"].find({"_id": {"$in": [ObjectId(eid) for eid in exam_ids]}})
+    exams_cursor = db.db["exams"].find(
+        {"_id": {"$in": [ObjectId(eid) for eid in exam_ids]}},
+        {"questions": 1, "prompt_template.version": 1}
+    )
     exams_list = await exams_cursor.to_list(len(exam_ids))
     exam_map = {str(ex["_id"]): ex for ex in exams_list}
 
+    # Failed answers are only "being retried" while the submission still has a grading job
+    retrying = await grading_queue.pending_submission_ids(
+        sub["_id"] for sub in submissions if sub.get("status") in FAILED_STATUSES)
+
     # Group results by subject (instead of exam title) for better organization
     grouped_results = {}
     for sub in submissions:
+        sub["grading_pending"] = str(sub["_id"]) in retrying
         if "submitted_at" in sub:
             sub["submitted_at"] = sub["submitted_at"].strftime("%Y-%m-%d %H:%M")
         
         # Enrich answers with rubric and question info from the exam map
         exam = exam_map.get(str(sub["exam_id"]))
         if exam:
-            for ans in sub.get("answers", []):
-                q = next((q for q in exam.get("questions", []) if q["id"] == ans["question_id"]), None)
-                if q:
-                    ans["question_text"] = q.get("text")
-                    ans["max_score"] = q.get("max_score")
-                    ans["rubric"] = q.get("rubric", [])
+            question_index.enrich_answers(exam, sub.get("answers", []))
 
         # Group by Subject
         subject = sub.get("subject", "ทั่วไป")
@@ -525,17 +619,13 @@ async def view_single_result(request: Request, submission_id: str, user: dict =
         raise HTTPException(status_code=403, detail="Not authorized to view this result")
     
     # Enrich with exam data
-    exam = await db.db["exams"].find_one({"_id": ObjectId(submission["exam_id"])})
+    exam = await exam_cache.get(submission["exam_id"])
     if exam:
         if "submitted_at" in submission:
             submission["submitted_at"] = submission["submitted_at"].strftime("%Y-%m-%d %H:%M")
             
-        for ans in submission.get("answers", []):
-            q = next((q for q in exam.get("questions", []) if q["id"] == ans["question_id"]), None)
-            if q:
-                ans["question_text"] = q.get("text")
-                ans["max_score"] = q.get("max_score")
-                ans["rubric"] = q.get("rubric", [])
+        question_index.enrich_answers(exam, submission.get("answers", []))
+    submission["grading_pending"] = bool(await grading_queue.pending_submission_ids([submission["_id"]]))
 
     # Wrap in grouped_results format to reuse results.html template
     grouped_results = {
@@ -556,6 +646,7 @@ async def delete_submission(request: Request, sub_id: str, user: dict = Depends(
     submission = await db.db["submissions"].find_one({"_id": ObjectId(sub_id)})
     if submission and submission["student_username"] == user["username"]:
         await db.db["submissions"].delete_one({"_id": ObjectId(sub_id)})
+        await stats_service.record_change(submission, None)
         
     return RedirectResponse(url="/results", status_code=303)
 
@@ -611,7 +702,11 @@ async def create_exam_submit(request: Request, user: dict = Depends(teacher_only
             created_by=user["username"]
         )
         
-        await db.db["exams"].insert_one(exam.model_dump(by_alias=True, exclude={"id"}))
+        exam_doc = exam.model_dump(by_alias=True, exclude={"id"})
+        for q in exam_doc["questions"]:
+            q["version"] = question_version(q)
+        exam_doc["prompt_template"] = compile_exam_prompt(exam_doc)
+        await db.db["exams"].insert_one(exam_doc)
         return RedirectResponse(url="/teacher/dashboard", status_code=303)
 
     except ValidationError as e:
@@ -693,15 +788,26 @@ async def edit_exam_submit(request: Request, exam_id: str, user: dict = Depends(
         if not existing_exam or existing_exam.get("created_by") != user["username"]:
              raise HTTPException(status_code=403, detail="You do not have permission to edit this exam.")
 
-        await db.db["exams"].update_one(
-            {"_id": ObjectId(exam_id)},
-            {"$set": {
-                "subject": form.get("subject"),
-                "title": form.get("title"),
-                "description": form.get("description"),
-                "questions": [q.model_dump() for q in questions]
-            }}
-        )
+        new_questions = [q.model_dump() for q in questions]
+        for q in new_questions:
+            q["version"] = question_version(q)
+        updated_exam = {
+            "subject": form.get("subject"),
+            "title": form.get("title"),
+            "description": form.get("description"),
+            "questions": new_questions
+        }
+        # Recompile the shared grading prompt; its version hash changes with the content
+        updated_exam["prompt_template"] = compile_exam_prompt(updated_exam)
+        await db.db["exams"].update_one({"_id": ObjectId(exam_id)}, {"$set": updated_exam, "$inc": {"version": 1}})
+        exam_cache.invalidate(exam_id)
+
+        # Drop cached AI grades of questions whose definition (version) changed
+        old_versions = {q["id"]: current_question_version(q) for q in existing_exam.get("questions", [])}
+        changed_ids = [q["id"] for q in new_questions if old_versions.get(q["id"]) != q["version"]]
+        changed_ids += [q_id for q_id in old_versions if q_id not in {q["id"] for q in new_questions}]
+        if changed_ids:
+            await grading_cache.invalidate_exam(exam_id, changed_ids)
         return RedirectResponse(url="/teacher/dashboard", status_code=303)
 
     except ValidationError as e:
@@ -739,46 +845,65 @@ async def delete_exam(request: Request, exam_id: str, user: dict = Depends(teach
     # Soft Delete: Set is_deleted to True
     await db.db["exams"].update_one(
         {"_id": ObjectId(exam_id)},
-        {"$set": {"is_deleted": True}}
+        {"$set": {"is_deleted": True}, "$inc": {"version": 1}}
     )
+    exam_cache.invalidate(exam_id)
     return RedirectResponse(url="/teacher/dashboard", status_code=303)
 
+@app.post("/teacher/exam/{exam_id}/regrade")
+async def regrade_exam(exam_id: str, user: dict = Depends(teacher_only)):
+    # Ownership Check
+    exam = await db.db["exams"].find_one({"_id": ObjectId(exam_id)}, {"title": 1, "created_by": 1, "questions": 1})
+    if not exam or exam.get("created_by") != user["username"]:
+         raise HTTPException(status_code=403, detail="You do not have permission to regrade this exam.")
+
+    # One queued job per submission instead of a task per click; workers grade them in shared calls
+    await regrade_service.start(exam, user["username"])
+    return RedirectResponse(url=f"/teacher/dashboard?regrade={exam_id}", status_code=303)
+
+@app.get("/teacher/exam/{exam_id}/regrade/progress")
+async def regrade_exam_progress(exam_id: str, user: dict = Depends(teacher_only)):
+    exam = await db.db["exams"].find_one({"_id": ObjectId(exam_id)}, {"created_by": 1})
+    if not exam or exam.get("created_by") != user["username"]:
+         raise HTTPException(status_code=403, detail="You do not have permission to view this exam.")
+    progress = await regrade_service.progress(exam_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="No regrade has been started for this exam")
+    return progress
+
 @app.get("/teacher/submissions", response_class=HTMLResponse)
 async def teacher_submissions(request: Request, user: dict = Depends(teacher_only)):
+    from pydantic import ValidationError
+
     # Get this teacher's exams first
-    teacher_exams = await db.db["exams"].find({"created_by": user["username"]}).to_list(1000)
+    teacher_exams = await db.db["exams"].find({"created_by": user["username"]}, {"subject": 1}).to_list(1000)
     exam_ids = [str(e["_id"]) for e in teacher_exams]
     exam_map = {str(e["_id"]): e.get("subject", "ไม่ได้ระบุ") for e in teacher_exams}
 
-    # Only show submissions for this teacher's exams
-    submissions = await db.db["submissions"].find({"exam_id": {"$in": exam_ids}}).sort("submitted_at", -1).to_list(1000)
+    # Only show submissions for this teacher's exams (summary fields only, no answers)
+    docs = await db.db["submissions"].find(
+        {"exam_id": {"$in": exam_ids}}, SubmissionSummaryModel.projection()
+    ).sort("submitted_at", -1).to_list(1000)
+    submissions = []
+    for doc in docs:
+        try:
+            submissions.append(SubmissionSummaryModel(**doc).model_dump())
+        except ValidationError as e:
+            # One malformed legacy document must not take down the whole list
+            print(f"Skipping submission {doc.get('_id')} in list: {e.errors()[0].get('msg')}")
     
     unique_subjects = sorted(list(set(exam_map.values())))
-    unique_students = sorted(list(set(sub.get("student_username") for sub in submissions if "student_username" in sub)))
+    unique_students = sorted(list(set(sub["student_username"] for sub in submissions if sub["student_username"])))
 
-    # Calculate Student Stats
-    student_stats = {}
-    for student in unique_students:
-        student_subs = [s for s in submissions if s.get("student_username") == student]
-        graded_subs = [s for s in student_subs if s.get("status") in ("graded", "reviewed")]
-        
-        avg_score = 0
-        if graded_subs:
-            sum_score = sum(s.get("teacher_total_score", s.get("total_score", 0)) for s in graded_subs)
-            avg_score = round(sum_score / len(graded_subs), 2)
-            
-        student_stats[student] = {
-            "count": len(student_subs),
-            "avg_score": avg_score
-        }
+    # Student Stats come from the materialized stats collection
+    student_stats = await stats_service.student_stats_for_exams(exam_ids)
 
     for sub in submissions:
-        sub["id"] = str(sub["_id"])
         # Fallback to map if subject missing in submission
-        if "subject" not in sub:
-            sub["subject"] = exam_map.get(str(sub["exam_id"]), "ไม่ได้ระบุ")
+        if not sub["subject"]:
+            sub["subject"] = exam_map.get(sub["exam_id"], "ไม่ได้ระบุ")
             
-        if "submitted_at" in sub:
+        if sub["submitted_at"]:
             sub["submitted_at"] = sub["submitted_at"].strftime("%Y-%m-%d %H:%M")
             
     return templates.TemplateResponse("teacher_submissions.html", {
@@ -796,21 +921,17 @@ async def review_submission_page(request: Request, sub_id: str, user: dict = Dep
     if not submission: return HTMLResponse("Submission not found", status_code=404)
     
     # Get associated exam
-    exam = await db.db["exams"].find_one({"_id": ObjectId(submission["exam_id"])})
+    exam = await exam_cache.get(submission["exam_id"])
     
     # Ownership Check
     if not exam or exam.get("created_by") != user["username"]:
         raise HTTPException(status_code=403, detail="You do not have permission to review this submission.")
     
-    # Enrich answers with question text and AI details
+    # Enrich answers with question text, max score and rubric for display
+    question_index.enrich_answers(exam, submission["answers"], keep_unknown=True)
     for ans in submission["answers"]:
-        q = next((q for q in exam["questions"] if q["id"] == ans["question_id"]), None)
-        ans["question_text"] = q["text"] if q else "Unknown Question"
-        ans["max_score"] = q["max_score"] if q else 10
         # Ensure AI fields exist for template safety
         ans["justification"] = ans.get("justification", "ไม่มีข้อมูล")
-        # Attach Rubric for display
-        ans["rubric"] = q.get("rubric", []) if q else []
         
     submission["id"] = str(submission["_id"])
     submission["submitted_at"] = submission["submitted_at"].strftime("%Y-%m-%d %H:%M")
@@ -825,57 +946,12 @@ async def review_submission_submit(request: Request, sub_id: str, user: dict = D
     submission = await db.db["submissions"].find_one({"_id": ObjectId(sub_id)})
     
     if action == "regrade":
-        # Get associated exam
-        exam = await db.db["exams"].find_one({"_id": ObjectId(submission["exam_id"])})
-        
-        # Define the grading function using Batch Processing
-        async def process_grading_task(sid, exam_obj, answers_list):
-            batch_data = []
-            for ans in answers_list:
-                q_id = ans["question_id"]
-                original_q = next((q for q in exam_obj["questions"] if q["id"] == q_id), None)
-                if original_q:
-                    batch_data.append({
-                        "question_text": original_q["text"],
-                        "student_answer": ans["answer_text"],
-                        "max_score": original_q["max_score"],
-                        "answer_key": original_q.get("answer_key"),
-                        "rubric": original_q.get("rubric")
-                    })
-
-            if batch_data:
-                results = await ai_service.grade_batch(batch_data, context={"student": submission["student_username"], "exam_id": submission["exam_id"], "action": "regrade"})
-                
-                total_score = 0
-                res_idx = 0
-                for ans in answers_list:
-                    original_q = next((q for q in exam_obj["questions"] if q["id"] == ans["question_id"]), None)
-                    if original_q and res_idx < len(results):
-                        res = results[res_idx]
-                        ans.update({
-                            "score": res.get("score", 0),
-                            "justification": res.get("justification"),
-                            "feedback": res.get("feedback"),
-                            "strengths": res.get("strengths"),
-                            "improvements": res.get("improvements")
-                        })
-                        total_score += res.get("score", 0)
-                        res_idx += 1
-
-                await db.db["submissions"].update_one(
-                    {"_id": sid},
-                    {"$set": {
-                        "answers": answers_list,
-                        "total_score": total_score,
-                        "status": "graded" 
-                    }}
-                )
-
-        # Trigger re-grading
-        asyncio.create_task(process_grading_task(ObjectId(sub_id), exam, submission["answers"]))
+        # Queue re-grading through the durable grading queue
+        await grading_queue.enqueue(sub_id, action="regrade", context={"student": submission["student_username"], "exam_id": submission["exam_id"]})
         return RedirectResponse(url="/teacher/submissions", status_code=303)
 
     # Normal save logic
+    before = stats_snapshot(submission)
     updated_answers = []
     total_teacher_score = 0
     audit_entries = []
@@ -897,69 +973,78 @@ async def review_submission_submit(request: Request, sub_id: str, user: dict = D
 
         ans["teacher_score"] = t_score
         ans["teacher_feedback"] = t_feedback
-        total_teacher_score += ans["teacher_score"]
+        # Answers the AI could not grade count as 0 until the teacher enters a score
+        total_teacher_score += ans["teacher_score"] or 0
         updated_answers.append(ans)
         
     # Log Change if any
     if audit_entries:
-        await db.db["audit_logs"].insert_one({
+        # Buffered off the request path; audit entries are never sampled or dropped
+        log_sink.write("audit_logs", {
             "submission_id": sub_id,
             "teacher": user["username"],
             "changes": audit_entries,
             "timestamp": datetime.now()
-        })
+        }, keep=True)
 
-    await db.db["submissions"].update_one(
+    # The revision bump tells a grading run that read the submission earlier to merge, not overwrite
+    replaced = await db.db["submissions"].find_one_and_update(
         {"_id": ObjectId(sub_id)},
-        {"$set": {
-            "answers": updated_answers,
-            "teacher_total_score": total_teacher_score,
-            "status": "reviewed"
-        }}
+        {
+            "$set": {
+                "answers": updated_answers,
+                "teacher_total_score": total_teacher_score,
+                "status": "reviewed"
+            },
+            "$inc": {"revision": 1}
+        },
+        projection={k: 1 for k in STATS_FIELDS},
+        return_document=ReturnDocument.BEFORE
     )
+    # Stats delta from the state actually replaced (grading may have saved since the read above)
+    before = stats_snapshot(replaced) if replaced else before
+    await stats_service.record_change(before, {**before, "teacher_total_score": total_teacher_score, "status": "reviewed"})
+    submission_events.publish(sub_id, "reviewed")
     
     return RedirectResponse(url="/teacher/submissions", status_code=303)
 
+def _export_response(exams: list, name: str, format: str):
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="Unsupported export format (use csv or xlsx).")
+    stream, media_type, extension = EXPORT_FORMATS[format]
+    header, question_ids = export_header(exams)
+    return StreamingResponse(
+        stream(header, iter_result_rows(exams, question_ids)),
+        media_type=media_type,
+        headers={"Content-Disposition": content_disposition(f"results_{name.replace(' ', '_')}.{extension}")}
+    )
+
 @app.get("/teacher/exam/{exam_id}/export")
-async def export_results(exam_id: str, user: dict = Depends(teacher_only)):
+async def export_results(exam_id: str, format: str = "csv", user: dict = Depends(teacher_only)):
     # Ownership Check
-    exam = await db.db["exams"].find_one({"_id": ObjectId(exam_id)})
-    if not exam or exam.get("created_by") != user["username"]:
-         raise HTTPException(status_code=403, detail="You do not have permission to export this exam.")
-
-    # Fetch all submissions for this exam
-    submissions = await db.db["submissions"].find({"exam_id": exam_id}).to_list(1000)
-    
+    exam = await db.db["exams"].find_one({"_id": ObjectId(exam_id)}, {"title": 1, "subject": 1, "created_by": 1, "questions.id": 1})
     if not exam:
         raise HTTPException(status_code=404, detail="Exam not found")
+    if exam.get("created_by") != user["username"]:
+         raise HTTPException(status_code=403, detail="You do not have permission to export this exam.")
 
-    output = io.StringIO()
-    writer = csv.writer(output)
-    
-    # Write Header
-    header = ["Student", "Submitted At", "AI Score", "Teacher Score", "Status"]
-    writer.writerow(header)
-    
-    for sub in submissions:
-        writer.writerow([
-            sub.get("student_username"),
-            sub.get("submitted_at").strftime("%Y-%m-%d %H:%M"),
-            sub.get("total_score"),
-            sub.get("teacher_total_score", ""),
-            sub.get("status")
-        ])
-    
-    output.seek(0)
-    filename = f"results_{exam['title'].replace(' ', '_')}.csv"
-    
-    return StreamingResponse(
-        io.BytesIO(output.getvalue().encode('utf-8-sig')), # Adding BOM for Excel compatibility with Thai text
-        media_type="text/csv",
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
-    )
+    # Rows are streamed from a cursor, so there is no cap on the number of submissions
+    return _export_response([exam], exam["title"], format)
+
+@app.get("/teacher/subject/{subject}/export")
+async def export_subject_results(subject: str, format: str = "csv", user: dict = Depends(teacher_only)):
+    exams = await db.db["exams"].find(
+        {"subject": subject, "created_by": user["username"], "is_deleted": {"$ne": True}},
+        {"title": 1, "subject": 1, "questions.id": 1}
+    ).sort("_id", 1).to_list(None)
+    if not exams:
+        raise HTTPException(status_code=404, detail="No exams found for this subject")
+    return _export_response(exams, subject, format)
 
 @app.get("/teacher/audit-logs", response_class=HTMLResponse)
 async def view_audit_logs(request: Request, user: dict = Depends(teacher_only)):
+    # Write out buffered entries first so a teacher sees their own latest review
+    await log_sink.flush("audit_logs")
     logs = await db.db["audit_logs"].find().sort("timestamp", -1).to_list(100)
     for log in logs:
         log["id"] = str(log["_id"])
@@ -969,30 +1054,8 @@ async def view_audit_logs(request: Request, user: dict = Depends(teacher_only)):
 
 @app.get("/teacher/students", response_class=HTMLResponse)
 async def view_students_performance(request: Request, user: dict = Depends(teacher_only)):
-    # Group submissions by student
-    submissions = await db.db["submissions"].find().to_list(2000)
-    student_stats = {}
-    
-    for sub in submissions:
-        username = sub["student_username"]
-        if username not in student_stats:
-            student_stats[username] = {"submissions": 0, "total_score": 0, "graded_count": 0}
-            
-        student_stats[username]["submissions"] += 1
-        if sub.get("status") in ["graded", "reviewed"]:
-            score = sub.get("teacher_total_score", sub.get("total_score", 0))
-            student_stats[username]["total_score"] += score
-            student_stats[username]["graded_count"] += 1
-            
-    # Calculate averages
-    performance_list = []
-    for user_id, stats in student_stats.items():
-        avg = round(stats["total_score"] / stats["graded_count"], 2) if stats["graded_count"] > 0 else 0
-        performance_list.append({
-            "username": user_id,
-            "submissions": stats["submissions"],
-            "avg_score": avg
-        })
+    # Per-student totals are maintained incrementally in the stats collection
+    performance_list = await stats_service.student_performance()
         
     return templates.TemplateResponse("student_performance.html", {
         "request": request, 
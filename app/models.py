@@ -29,6 +29,7 @@ class QuestionModel(BaseModel):
     answer_key: Optional[str] = Field(default=None, min_length=1) # เฉลย/แนวคำตอบ
     grading_criteria: Optional[str] = None # เกณฑ์การให้คะแนน (Legacy/Simple)
     rubric: List[RubricItem] = [] # New structured rubric
+    version: Optional[str] = None # Content hash (prompt_templates.question_version), set on save
 
 class ExamModel(BaseModel):
     id: Optional[PyObjectId] = Field(default=None, alias="_id")
@@ -53,6 +54,15 @@ class AnswerModel(BaseModel):
     teacher_score: Optional[float] = None
     teacher_feedback: Optional[str] = None
 
+class GradingResultModel(BaseModel):
+    """One graded item as returned by the AI (validated before it is stored)."""
+    id: Optional[Annotated[str, BeforeValidator(str)]] = None
+    score: float = Field(..., ge=0)
+    justification: Optional[str] = None
+    feedback: Optional[str] = None
+    strengths: Optional[str] = None
+    improvements: Optional[str] = None
+
 class SubmissionModel(BaseModel):
     id: Optional[PyObjectId] = Field(default=None, alias="_id")
     exam_id: str
@@ -66,3 +76,23 @@ class SubmissionModel(BaseModel):
         populate_by_name = True
         arbitrary_types_allowed = True
         json_encoders = {ObjectId: str}
+
+class SubmissionSummaryModel(BaseModel):
+    """The fields list pages show for a submission; read with `projection()` (no answers)."""
+    id: PyObjectId = Field(alias="_id")
+    exam_id: str
+    exam_title: Optional[str] = None  # denormalized at submit time
+    subject: Optional[str] = None
+    student_username: str = ""  # legacy/partial documents may lack it
+    status: str = "submitted"
+    total_score: Optional[float] = None
+    teacher_total_score: Optional[float] = None
+    max_score: Optional[float] = None
+    submitted_at: Optional[datetime] = None
+
+    class Config:
+        populate_by_name = True
+
+    @classmethod
+    def projection(cls) -> dict:
+        return {(field.alias or name): 1 for name, field in cls.model_fields.items()}
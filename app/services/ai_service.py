@@ -1,143 +1,291 @@
 import json
-import re
 import asyncio
+import time
 from datetime import datetime
 from app.config import settings
-from app.database import db
+from app.services.rate_limiter import gemini_limiter, backoff_delay, is_rate_limit_error
+from app.services.grading_backends import create_backend
+from app.services.prompt_templates import prompt_templates, format_rubric, GRADER_INSTRUCTIONS, GRADING_RULES
+from app.services.batch_planner import batch_planner
+from app.services.log_sink import log_sink
+from app.services.metrics import gemini_call_duration, gemini_tokens, gemini_retries, gemini_errors, gemini_items
+from app.models import GradingResultModel
+from pydantic import ValidationError
 import traceback
 
 class AIService:
-    def __init__(self):
-        self._genai = None
-        self._model = None
-        # Lazy initialization for semaphore to avoid event loop issues
-        self._semaphore = None
+    def __init__(self, backend=None):
+        # Lazy initialization so the backend is chosen from Settings on first use
+        self._backend = backend
 
     @property
-    def genai(self):
-        """Lazy load google.generativeai and configure it."""
-        if self._genai is None:
-            print("DEBUG: Lazy loading google.generativeai...")
-            import google.generativeai as genai
-            
-            api_key = settings.GEMINI_API_KEY.strip()
-            key_len = len(api_key)
-            print(f"DEBUG: Loading Gemini API Key. Length: {key_len}")
-            
-            if key_len < 30:
-                print("WARNING: API Key looks too short! (Usually around 39 characters)")
-                
-            genai.configure(api_key=api_key)
-            self._genai = genai
-        return self._genai
+    def backend(self):
+        if self._backend is None:
+            self._backend = create_backend()
+            print(f"Grading backend: {self._backend.name} ({self._backend.model_name})")
+        return self._backend
 
-    @property
-    def model(self):
-        """Lazy load the generative model."""
-        if self._model is None:
-            # ใช้ชื่อโมเดลที่แนะนำและเสถียรที่สุด
-            self._model = self.genai.GenerativeModel('gemini-flash-latest')
-        return self._model
+    @backend.setter
+    def backend(self, value):
+        self._backend = value
 
     @property
-    def semaphore(self):
-        if self._semaphore is None:
-            self._semaphore = asyncio.Semaphore(5)
-        return self._semaphore
+    def model_name(self):
+        return self.backend.model_name
 
-    async def grade_batch(self, questions_data: list, context: dict = None):
+    def _build_prompt(self, items: list, prefix: str = None) -> str:
         """
-        Grades all answers in one go for maximum quota efficiency.
-        questions_data: list of dicts {question_text, student_answer, max_score, answer_key, rubric}
+        Per-call part of the prompt. With an exam `prefix` (see prompt_templates) only the
+        answers are listed; otherwise every item carries its full question definition.
         """
-        async with self.semaphore:
-            print(f"AI Batch Grading started for {len(questions_data)} questions.")
-            
-            questions_prompt = ""
-            for i, q in enumerate(questions_data):
-                rubric_text = ""
-                if q.get('rubric'):
-                    rubric_text = "\n[เกณฑ์ Rubric]\n"
-                    for item in q['rubric']:
-                        if hasattr(item, 'dict'): item = item.dict()
-                        rubric_text += f"- {item.get('score')} คะแนน: {item.get('description')}\n"
-
-                questions_prompt += f"""
+        if prefix:
+            answers_prompt = ""
+            for q in items:
+                answers_prompt += f"""
+--- รายการ {q['item_id']} ---
+รหัสรายการ (id): {q['item_id']}
+ข้อสอบ: {q['question_id']}
+คำตอบของนักเรียน: {q['student_answer']}
+"""
+            return answers_prompt
+
+        questions_prompt = ""
+        for i, q in enumerate(items):
+            questions_prompt += f"""
 --- ข้อที่ {i+1} ---
+รหัสรายการ (id): {q['item_id']}
 โจทย์: {q['question_text']}
 แนวคำตอบ: {q.get('answer_key') or 'ไม่ได้ระบุ'}
 คะแนนเต็ม: {q['max_score']}
-{rubric_text}
+{format_rubric(q.get('rubric'))}
 คำตอบของนักเรียน: {q['student_answer']}
 """
 
-            prompt = f"""
-คุณคือระบบผู้เชี่ยวชาญในการตรวจข้อสอบอัตนัย (Subjective Exam Grader) 
-จงประเมินคำตอบของนักเรียนทีละข้อตามข้อมูลที่กำหนดให้ โดยให้คะแนนอย่างเที่ยงตรงตามเกณฑ์
-
+        return f"""{GRADER_INSTRUCTIONS}
 [ข้อมูลข้อสอบ]
 {questions_prompt}
+{GRADING_RULES}"""
 
-[กฎการตรวจ]
-1. ประเมินความถูกต้องตามหลักวิชาการและเกณฑ์ที่ให้มา
-2. ให้คะแนนสุทธิ [0 ถึง คะแนนเต็ม] เท่านั้น
-3. สำหรับแต่ละข้อ จงระบุจุดแข็ง (Strengths) และสิ่งที่ควรปรับปรุง (Improvements)
-
-[รูปแบบการตอบกลับ (Strict JSON Array)]
-จงตอบกลับเป็น JSON Array ของอ็อบเจกต์ในลำดับที่ถูกต้อง ดังนี้:
-[
-    {{
-        "score": [คะแนนข้อ 1],
-        "justification": "[เหตุผลสั้นๆ]",
-        "feedback": "[คำแนะนำรวม]",
-        "strengths": "[จุดเด่น]",
-        "improvements": "[จุดที่ควรแก้]"
-    }},
-    ...
-]
-"""
-            for attempt in range(3):
+    async def _exam_prefix(self, items: list):
+        """The compiled exam prompt when every item belongs to the same exam version."""
+        keys = {(q.get("exam_id"), q.get("prompt_version")) for q in items}
+        if len(keys) != 1:
+            return None
+        exam_id, version = keys.pop()
+        if not exam_id or not version or any(not q.get("question_id") for q in items):
+            return None
+        try:
+            return await prompt_templates.get(str(exam_id), version)
+        except Exception as e:
+            print(f"  Prompt template lookup failed, using full prompt: {e}")
+            return None
+
+    async def grade_batch(self, questions_data: list, context: dict = None):
+        """
+        Grades all answers in one go for maximum quota efficiency.
+        questions_data: list of dicts {question_text, student_answer, max_score, answer_key, rubric}
+        Items may carry an "item_id"; results are then matched back by id instead of position.
+        Valid results are kept from every response. A batch that still has failed items
+        is split in halves and each half is graded on its own, down to single items,
+        so one poisonous answer or a transient error only costs a fraction of the work.
+        Items that never produce a valid result come back as {"score": None, "grading_error": True}.
+        Large inputs are first split by the batch planner so every call fits the token budgets.
+        """
+        print(f"AI Batch Grading started for {len(questions_data)} questions.")
+        started = time.monotonic()
+        items = [{**q, "item_id": str(q.get("item_id") or i + 1)} for i, q in enumerate(questions_data)]
+        results = [None] * len(items)
+        errors = {}
+        usage = {"model_latency_ms": 0, "prompt_tokens": 0, "output_tokens": 0, "cached_tokens": 0, "call_errors": {}}
+        prefix = await self._exam_prefix(items)
+
+        await batch_planner.load({q.get("exam_id") for q in items})
+        if prefix:
+            chunks = batch_planner.plan(items, batch_planner.prompt_tokens(prefix), with_question=False)
+        else:
+            chunks = batch_planner.plan(items, batch_planner.prompt_tokens(GRADER_INSTRUCTIONS + GRADING_RULES))
+        if len(chunks) > 1:
+            print(f"  Token budget: {len(items)} items planned as {len(chunks)} calls ({', '.join(str(len(c)) for c in chunks)})")
+        counts = await asyncio.gather(*(
+            self._grade_split(items, chunk, results, errors, usage, prefix) for chunk in chunks
+        ))
+        calls = sum(counts)
+
+        failed = [i for i, r in enumerate(results) if r is None]
+        gemini_retries.inc(calls - len(chunks))
+        gemini_items.inc(len(items) - len(failed), result="ok")
+        gemini_items.inc(len(failed), result="failed")
+        # Written in the background; failed batches are never sampled out
+        log_sink.write("ai_logs", {
+            "timestamp": datetime.now(),
+            "context": context,
+            "status": "success" if not failed else ("partial" if len(failed) < len(items) else "failed"),
+            "batch_size": len(items),
+            "failed_items": [items[i]["item_id"] for i in failed],
+            "calls": calls,
+            "prompt_version": items[0].get("prompt_version") if prefix else None,
+            "error": next(iter(errors.values()), None) if failed else None,
+            "latency_ms": round((time.monotonic() - started) * 1000),
+            **usage
+        }, keep=bool(failed))
+
+        for i in failed:
+            results[i] = {
+                "score": None,
+                "feedback": "เกิดข้อผิดพลาดในการตรวจ",
+                "grading_error": True,
+                "error": errors.get(i, "invalid or missing result")
+            }
+        return results
+
+    async def _grade_split(self, items: list, indexes: list, results: list, errors: dict, usage: dict,
+                           prefix: str = None, depth: int = 0) -> int:
+        """
+        Grades items[indexes] into `results`. When the call returned but some items were
+        invalid or missing (or the response was blocked), those items are bisected to isolate
+        the bad ones. Whole-call errors (429, 5xx, timeouts, auth) are retried on the same
+        batch with backoff, since splitting would only multiply failing requests during an
+        outage. Up to GEMINI_MAX_ATTEMPTS attempts per batch; returns the number of model calls made.
+        """
+        pending = indexes
+        calls = 0
+        attempt = 0
+        while pending:
+            attempt += 1
+            calls += 1
+            error = await self._attempt([items[i] for i in pending], pending, results, usage, prefix)
+            failed = [i for i in pending if results[i] is None]
+            if not failed:
+                return calls
+            for i in failed:
+                errors[i] = str(error) if error else "invalid or missing result"
+
+            call_failed = isinstance(error, Exception)
+            if len(failed) > 1 and not call_failed:
+                mid = len(failed) // 2
+                print(f"  {'  ' * depth}Splitting {len(failed)} failed items into {mid} + {len(failed) - mid}")
+                counts = await asyncio.gather(
+                    self._grade_split(items, failed[:mid], results, errors, usage, prefix, depth + 1),
+                    self._grade_split(items, failed[mid:], results, errors, usage, prefix, depth + 1)
+                )
+                return calls + sum(counts)
+            if attempt >= settings.GEMINI_MAX_ATTEMPTS:
+                return calls
+            pending = failed
+            await asyncio.sleep(backoff_delay(attempt))
+        return calls
+
+    async def _attempt(self, batch: list, indexes: list, results: list, usage: dict, prefix: str = None):
+        """
+        One model call for `batch`; stores valid results and returns the call error, if any.
+        Latency, tokens and error kinds are added to `usage` for the batch's ai_logs entry.
+        """
+        prompt = self._build_prompt(batch, prefix)
+        # Reserve prompt + expected output tokens against the tokens-per-minute budget
+        estimated_input = batch_planner.prompt_tokens(prefix or "") + batch_planner.prompt_tokens(prompt)
+        estimated_tokens = estimated_input + sum(batch_planner.output_tokens(q) for q in batch)
+        latency = None
+        try:
+            print(f"  Calling {self.backend.name} backend for {len(batch)} items...")
+            async with gemini_limiter.slot(estimated_tokens):
+                started = time.monotonic()
                 try:
-                    print(f"  Attempt {attempt+1}: Calling Gemini API for single batch...")
-                    response = await self.model.generate_content_async(prompt)
-                    
-                    if not response.parts:
-                        print(f"  Warning: Response was blocked or empty.")
-                        continue
-                        
-                    text = response.text
-                    json_str = text
-                    if "```json" in text:
-                        json_str = text.split("```json")[1].split("```")[0].strip()
-                    elif "```" in text:
-                        json_str = text.split("```")[1].split("```")[0].strip()
-                    
-                    match = re.search(r'\[.*\]', json_str, re.DOTALL)
-                    if match:
-                        results = json.loads(match.group())
-                        if len(results) == len(questions_data):
-                            print(f"  Successfully parsed {len(results)} results.")
-                            # Success log
-                            try:
-                                await db.db["ai_logs"].insert_one({
-                                    "timestamp": datetime.now(),
-                                    "context": context,
-                                    "status": "success",
-                                    "batch_size": len(questions_data)
-                                })
-                            except Exception as db_e:
-                                print(f"  DB Log Error (Non-critical): {db_e}")
-                            return results
-                        else:
-                            print(f"  Batch size mismatch: expected {len(questions_data)}, got {len(results)}")
-                    else:
-                        print(f"  Failed to find JSON array in response: {text[:100]}...")
-                except Exception as e:
-                    print(f"  Batch attempt {attempt+1} failed: {e}")
-                    await asyncio.sleep(1)
-
-            # Fallback to empty results
-            return [{"score": 0, "feedback": "เกิดข้อผิดพลาดในการตรวจ"} for _ in range(len(questions_data))]
+                    response = await self.backend.generate(prompt, batch, prefix=prefix)
+                finally:
+                    latency = time.monotonic() - started
+                    usage["model_latency_ms"] += round(latency * 1000)
+                gemini_limiter.on_success(latency)
+            gemini_limiter.record_usage(estimated_tokens, response.total_tokens)
+        except Exception as e:
+            print(f"  Grading call failed: {e}")
+            gemini_limiter.on_error(e)
+            kind = "rate_limit" if is_rate_limit_error(e) else "error"
+            gemini_errors.inc(kind=kind)
+            usage["call_errors"][kind] = usage["call_errors"].get(kind, 0) + 1
+            if latency is not None:
+                gemini_call_duration.observe(latency, backend=self.backend.name, outcome=kind)
+            return e
+
+        gemini_tokens.inc(response.prompt_tokens, kind="prompt")
+        gemini_tokens.inc(response.output_tokens, kind="output")
+        gemini_tokens.inc(response.cached_tokens, kind="cached")
+        for kind in ("prompt_tokens", "output_tokens", "cached_tokens"):
+            usage[kind] += getattr(response, kind)
+        if response.blocked or not response.text:
+            print(f"  Warning: Response was blocked or empty.")
+            gemini_errors.inc(kind="blocked")
+            usage["call_errors"]["blocked"] = usage["call_errors"].get("blocked", 0) + 1
+            gemini_call_duration.observe(latency, backend=self.backend.name, outcome="blocked")
+            return "blocked or empty response"
+
+        await batch_planner.record(batch, estimated_input, response.prompt_tokens, response.output_tokens)
+        parsed = self._match_results(self._parse_response(response.text), batch)
+        for i, result in zip(indexes, parsed):
+            if result is not None:
+                results[i] = result
+        invalid = sum(1 for r in parsed if r is None)
+        if invalid:
+            print(f"  {invalid} of {len(batch)} items invalid or missing.")
+            gemini_errors.inc(kind="invalid_items")
+            usage["call_errors"]["invalid_items"] = usage["call_errors"].get("invalid_items", 0) + 1
+        gemini_call_duration.observe(latency, backend=self.backend.name, outcome="ok" if not invalid else "partial")
+        return None
+
+    def _parse_response(self, text: str) -> list:
+        """
+        Extracts result objects from a model response.
+        JSON mode normally returns a clean array; otherwise strip code fences and, if the
+        array is truncated or broken, salvage every complete object before the damage.
+        """
+        text = text.strip()
+        if "```" in text:
+            text = text.split("```json")[1] if "```json" in text else text.split("```")[1]
+            text = text.split("```")[0].strip()
+        try:
+            data = json.loads(text)
+            if isinstance(data, dict):
+                data = data.get("results", [data])
+            return data if isinstance(data, list) else []
+        except json.JSONDecodeError:
+            pass
+
+        decoder = json.JSONDecoder()
+        objects = []
+        pos = text.find("[") + 1
+        while True:
+            pos = text.find("{", pos)
+            if pos == -1:
+                break
+            try:
+                obj, pos = decoder.raw_decode(text, pos)
+                objects.append(obj)
+            except json.JSONDecodeError:
+                break
+        return objects
+
+    def _match_results(self, results: list, batch: list) -> list:
+        """
+        Lines parsed results up with `batch` by item id (or by position when the model
+        left out the ids) and validates each one. Missing or invalid entries are None.
+        """
+        by_id = {str(r.get("id")): r for r in results if isinstance(r, dict) and r.get("id") is not None}
+        if not by_id and len(results) == len(batch):
+            by_id = {item["item_id"]: r for item, r in zip(batch, results)}
+
+        matched = []
+        for item in batch:
+            raw = by_id.get(item["item_id"])
+            try:
+                result = GradingResultModel.model_validate(raw)
+            except ValidationError:
+                matched.append(None)
+                continue
+            if result.score > item["max_score"]:
+                print(f"  Item {item['item_id']}: score {result.score} exceeds max {item['max_score']}")
+                matched.append(None)
+                continue
+            matched.append(result.model_dump(exclude={"id"}, exclude_none=True))
+        return matched
 
     async def grade_answer(self, question_text: str, student_answer: str, max_score: int, answer_key: str = None, grading_criteria: str = None, rubric: list = None, context: dict = None):
         # Single grading now just calls the batch with one item for consistency or remains as is
@@ -0,0 +1,102 @@
+import asyncio
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+from passlib.context import CryptContext
+from app.config import settings
+from app.database import db
+from app.services.ttl_cache import TTLCache
+
+USER_FIELDS = {"username": 1, "role": 1, "enrolled_subjects": 1}
+
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.BCRYPT_ROUNDS)
+
+# bcrypt releases the GIL, so a small thread pool keeps hashing off the event loop
+# and bounds how many hashes run at once during a login rush
+_password_pool = ThreadPoolExecutor(max_workers=settings.PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+
+
+async def hash_password(password: str) -> str:
+    return await asyncio.get_running_loop().run_in_executor(_password_pool, pwd_context.hash, password)
+
+
+async def verify_password(password: str, hashed: str) -> bool:
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_password_pool, pwd_context.verify, password, hashed)
+    except ValueError:
+        # Malformed or unknown hash format stored for this user
+        return False
+
+
+def password_needs_rehash(hashed: str) -> bool:
+    """True when the hash was made with a different cost factor than BCRYPT_ROUNDS."""
+    return pwd_context.needs_update(hashed)
+
+
+# Values shipped in .env.example; a deployment still using them has a guessable key
+PLACEHOLDER_SESSION_SECRETS = {"change_me_to_a_long_random_string"}
+
+
+def _session_secret() -> str:
+    secret = settings.SESSION_SECRET.strip()
+    if secret and secret not in PLACEHOLDER_SESSION_SECRETS:
+        return secret
+    if settings.SESSION_DEV_RANDOM_SECRET:
+        print("WARNING: SESSION_SECRET is not set; SESSION_DEV_RANDOM_SECRET is on, using a random key "
+              "(sessions end on restart and are not shared between processes). Do not use this in production.")
+        return secrets.token_urlsafe(32)
+    raise RuntimeError(
+        "SESSION_SECRET is missing or still the .env.example placeholder. Set it to a long random string "
+        "(python -c \"import secrets; print(secrets.token_urlsafe(32))\"), the same on every server and worker, "
+        "or set SESSION_DEV_RANDOM_SECRET=true for local development."
+    )
+
+
+_serializer = URLSafeTimedSerializer(_session_secret(), salt="user-session")
+
+
+def create_session_token(username: str) -> str:
+    """Signed value for the `user_session` cookie."""
+    return _serializer.dumps({"u": username})
+
+
+def read_session_token(token: str):
+    """Returns the username of a valid session token, or None if it is forged or expired."""
+    try:
+        data = _serializer.loads(token, max_age=settings.SESSION_MAX_AGE_SECONDS)
+    except (BadSignature, SignatureExpired):
+        return None
+    return data.get("u") if isinstance(data, dict) else None
+
+
+class UserCache:
+    """TTL-bounded LRU of user documents so authentication usually skips the database."""
+
+    def __init__(self):
+        self._users = TTLCache(
+            lambda: settings.USER_CACHE_MAX_ENTRIES, lambda: settings.USER_CACHE_TTL_SECONDS
+        )  # username -> user dict
+
+    async def get(self, username: str):
+        user = self._users.get(username)
+        if user is None:
+            user = await db.db["users"].find_one({"username": username}, USER_FIELDS)
+            if not user:
+                self._users.pop(username, None)
+                return None
+            user = {
+                "username": user["username"],
+                "role": user.get("role", "student"),
+                "enrolled_subjects": user.get("enrolled_subjects", [])
+            }
+            self._users.set(username, user)
+        # Copy so request handlers cannot modify the cached entry
+        return {**user, "enrolled_subjects": list(user["enrolled_subjects"])}
+
+    def invalidate(self, username: str):
+        """Call after changing a user's role or enrollments."""
+        self._users.pop(username, None)
+
+
+user_cache = UserCache()
@@ -0,0 +1,140 @@
+import re
+from app.config import settings
+from app.database import db
+
+# Thai script has no spaces and tokenizes at roughly 2 characters per token;
+# other text averages about 4 characters per token, punctuation is usually its own token
+_THAI_RUN = re.compile(r"[\u0E00-\u0E7F]+")
+_WORD = re.compile(r"[A-Za-z0-9]+")
+_SYMBOL = re.compile(r"[^\sA-Za-z0-9\u0E00-\u0E7F]")
+
+
+def count_tokens(text: str) -> int:
+    """Offline token estimate by script (no network round trip per item)."""
+    if not text:
+        return 0
+    text = str(text)
+    thai = sum((len(run) + 1) // 2 for run in _THAI_RUN.findall(text))
+    words = sum((len(word) + 3) // 4 for word in _WORD.findall(text))
+    symbols = len(_SYMBOL.findall(text))
+    return thai + words + symbols
+
+
+class BatchPlanner:
+    """
+    Sizes grading calls under GRADING_MAX_INPUT_TOKENS_PER_CALL and
+    GRADING_MAX_OUTPUT_TOKENS_PER_CALL. Input is estimated with count_tokens
+    (calibrated against the token counts the model reports); output per item
+    comes from per-exam statistics of answer length and observed response size,
+    kept in the `stats` collection as `exam_tokens:<exam_id>`.
+    """
+
+    ITEM_OVERHEAD_TOKENS = 20  # item id, labels and separators around each answer
+
+    def __init__(self):
+        self._exams = {}  # exam_id -> {"answers", "answer_tokens", "output_items", "output_tokens"}
+        self.calibration = 1.0  # reported prompt tokens / estimated prompt tokens (moving average)
+
+    @property
+    def collection(self):
+        return db.db["stats"]
+
+    def _raw_input_tokens(self, item: dict, with_question: bool) -> int:
+        tokens = count_tokens(item.get("student_answer", "")) + self.ITEM_OVERHEAD_TOKENS
+        if with_question:
+            text = f"{item.get('question_text', '')}{item.get('answer_key') or ''}"
+            for r in item.get("rubric") or []:
+                if hasattr(r, 'dict'): r = r.dict()
+                text += str(r.get("description", ""))
+            tokens += count_tokens(text) + self.ITEM_OVERHEAD_TOKENS
+        return tokens
+
+    def input_tokens(self, item: dict, with_question: bool = True) -> int:
+        """Prompt tokens one item adds; without the question when the exam prefix carries it."""
+        return int(self._raw_input_tokens(item, with_question) * self.calibration)
+
+    def prompt_tokens(self, text: str) -> int:
+        return int(count_tokens(text) * self.calibration)
+
+    def output_tokens(self, item: dict) -> int:
+        """Expected response tokens for one item, scaled by how long this answer is for its exam."""
+        stats = self._exams.get(str(item.get("exam_id")))
+        if not stats or not stats["output_items"]:
+            return settings.GRADING_OUTPUT_TOKENS_PER_ITEM
+        per_item = stats["output_tokens"] / stats["output_items"]
+        if stats["answers"] and stats["answer_tokens"]:
+            avg_answer = stats["answer_tokens"] / stats["answers"]
+            ratio = count_tokens(item.get("student_answer", "")) / avg_answer
+            per_item *= min(max(ratio, 0.5), 2.0)
+        return int(per_item) + 1
+
+    def plan(self, items: list, prefix_tokens: int = 0, with_question: bool = True) -> list:
+        """
+        Splits `items` (in order) into index lists whose estimated input (on top of the
+        fixed `prefix_tokens`) and output both stay within the per-call budgets.
+        An item that alone exceeds a budget still gets a call of its own.
+        """
+        input_budget = settings.GRADING_MAX_INPUT_TOKENS_PER_CALL - prefix_tokens
+        output_budget = settings.GRADING_MAX_OUTPUT_TOKENS_PER_CALL
+        batches, current, used_in, used_out = [], [], 0, 0
+        for i, item in enumerate(items):
+            cost_in = self.input_tokens(item, with_question)
+            cost_out = self.output_tokens(item)
+            if current and (used_in + cost_in > input_budget or used_out + cost_out > output_budget):
+                batches.append(current)
+                current, used_in, used_out = [], 0, 0
+            current.append(i)
+            used_in += cost_in
+            used_out += cost_out
+        if current:
+            batches.append(current)
+        return batches
+
+    async def load(self, exam_ids):
+        """Reads the statistics of exams not seen by this process yet."""
+        missing = [str(e) for e in exam_ids if e and str(e) not in self._exams]
+        if not missing:
+            return
+        for exam_id in missing:
+            self._exams[exam_id] = {"answers": 0, "answer_tokens": 0, "output_items": 0, "output_tokens": 0}
+        try:
+            docs = await self.collection.find({"_id": {"$in": [f"exam_tokens:{e}" for e in missing]}}).to_list(None)
+        except Exception as e:
+            print(f"Token stats load error (Non-critical): {e}")
+            return
+        for doc in docs:
+            self._exams[doc["exam_id"]] = {k: doc.get(k, 0) for k in ("answers", "answer_tokens", "output_items", "output_tokens")}
+
+    async def record(self, items: list, estimated_prompt_tokens: int, prompt_tokens: int, output_tokens: int):
+        """Feeds one successful call back: calibration from the reported prompt size, per-exam averages."""
+        if prompt_tokens and estimated_prompt_tokens:
+            observed = self.calibration * prompt_tokens / estimated_prompt_tokens
+            self.calibration = min(max(0.9 * self.calibration + 0.1 * observed, 0.25), 4.0)
+
+        per_exam = {}
+        for item in items:
+            exam_id = item.get("exam_id")
+            if not exam_id:
+                continue
+            inc = per_exam.setdefault(str(exam_id), {"answers": 0, "answer_tokens": 0, "output_items": 0, "output_tokens": 0})
+            inc["answers"] += 1
+            inc["answer_tokens"] += count_tokens(item.get("student_answer", ""))
+            if output_tokens:
+                inc["output_items"] += 1
+                inc["output_tokens"] += output_tokens / len(items)
+
+        for exam_id, inc in per_exam.items():
+            stats = self._exams.setdefault(exam_id, {"answers": 0, "answer_tokens": 0, "output_items": 0, "output_tokens": 0})
+            for k, v in inc.items():
+                stats[k] += v
+            try:
+                await self.collection.update_one(
+                    {"_id": f"exam_tokens:{exam_id}"},
+                    {"$inc": inc, "$set": {"kind": "exam_tokens", "exam_id": exam_id}},
+                    upsert=True
+                )
+            except Exception as e:
+                print(f"Token stats update error (Non-critical): {e}")
+
+
+batch_planner = BatchPlanner()
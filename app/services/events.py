@@ -0,0 +1,97 @@
+import asyncio
+from bson import ObjectId
+from app.config import settings
+from app.database import db
+from app.services.ttl_cache import TTLCache
+
+# Statuses after which the waiting page can move on (failed answers are retried in the background)
+FINAL_STATUSES = ("graded", "reviewed", "partially_graded", "grading_failed")
+
+
+class SubmissionEvents:
+    """
+    In-process pub/sub of submission status changes.
+    The grading pipeline publishes; SSE connections subscribe per submission.
+    Also keeps a small TTL cache of recent statuses for the polling fallback.
+    """
+
+    def __init__(self):
+        self._subscribers = {}  # submission_id -> set of asyncio.Queue
+        self._status_cache = TTLCache(
+            lambda: settings.STATUS_CACHE_MAX_ENTRIES, lambda: settings.STATUS_CACHE_TTL_SECONDS
+        )  # submission_id -> status
+        self._watch_task = None
+
+    def subscribe(self, submission_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self._subscribers.setdefault(str(submission_id), set()).add(queue)
+        return queue
+
+    def unsubscribe(self, submission_id: str, queue: asyncio.Queue):
+        queues = self._subscribers.get(str(submission_id))
+        if queues:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[str(submission_id)]
+
+    def publish(self, submission_id, status: str):
+        submission_id = str(submission_id)
+        self._cache_status(submission_id, status)
+        for queue in self._subscribers.get(submission_id, ()):
+            queue.put_nowait(status)
+
+    def _cache_status(self, submission_id: str, status: str):
+        self._status_cache.set(submission_id, status)
+
+    async def get_status(self, submission_id: str):
+        """Current status from the cache, or a projected read of just the status field."""
+        cached = self._status_cache.get(submission_id)
+        if cached is not None:
+            return cached
+        submission = await db.db["submissions"].find_one({"_id": ObjectId(submission_id)}, {"status": 1})
+        if not submission:
+            return None
+        status = submission.get("status", "submitted")
+        self._cache_status(submission_id, status)
+        return status
+
+    async def _watch_submissions(self):
+        """Relays status changes made by other processes (requires a replica set)."""
+        pipeline = [{"$match": {
+            "operationType": "update",
+            "updateDescription.updatedFields.status": {"$exists": True}
+        }}]
+        while True:
+            try:
+                async with db.db["submissions"].watch(pipeline) as stream:
+                    async for change in stream:
+                        status = change["updateDescription"]["updatedFields"]["status"]
+                        self.publish(change["documentKey"]["_id"], status)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Submission change stream error (retrying): {e}")
+                await asyncio.sleep(5)
+
+    @property
+    def recheck_interval(self) -> float:
+        """
+        How often an SSE stream re-reads the status. Events only arrive in-process when
+        grading runs here or a change stream relays them; otherwise fall back to polling.
+        """
+        if settings.GRADING_WORKERS_IN_WEB or settings.SUBMISSION_CHANGE_STREAM:
+            return settings.SSE_HEARTBEAT_SECONDS
+        return min(settings.SSE_HEARTBEAT_SECONDS, settings.GRADING_POLL_INTERVAL)
+
+    def start(self):
+        if settings.SUBMISSION_CHANGE_STREAM and self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch_submissions())
+
+    async def stop(self):
+        if self._watch_task:
+            self._watch_task.cancel()
+            await asyncio.gather(self._watch_task, return_exceptions=True)
+            self._watch_task = None
+
+
+submission_events = SubmissionEvents()
@@ -0,0 +1,106 @@
+from bson import ObjectId
+from app.config import settings
+from app.database import db
+from app.services.ttl_cache import TTLCache
+
+# Unknown questions (removed from the exam since the answer was written) on the review page
+UNKNOWN_QUESTION = {"text": "Unknown Question", "max_score": 10, "rubric": []}
+
+
+def exam_version(exam: dict):
+    """Version of the exam content, or None for exams saved before templates existed."""
+    return (exam.get("prompt_template") or {}).get("version")
+
+
+class QuestionIndex:
+    """
+    id -> question maps, built once per exam content version and kept in a
+    small LRU, so looking up the question of an answer is O(1) instead of a
+    scan over exam["questions"] per answer. The cached maps are shared between
+    requests and must not be mutated.
+    """
+
+    MAX_ENTRIES = 512
+
+    def __init__(self):
+        self._indexes = TTLCache(self.MAX_ENTRIES)  # (exam_id, version) -> {question_id: question}
+
+    def questions(self, exam: dict) -> dict:
+        version = exam_version(exam)
+        if version is None:
+            return {q["id"]: q for q in exam.get("questions", [])}
+        key = (str(exam["_id"]), version)
+        index = self._indexes.get(key)
+        if index is None:
+            index = {q["id"]: q for q in exam.get("questions", [])}
+            self._indexes.set(key, index)
+        return index
+
+    def enrich_answers(self, exam: dict, answers: list, keep_unknown: bool = False):
+        """
+        Adds question_text, max_score and rubric of each answer's question for display.
+        With `keep_unknown`, answers to removed questions get placeholder values.
+        """
+        index = self.questions(exam)
+        for ans in answers:
+            q = index.get(ans.get("question_id"))
+            if q is None:
+                if not keep_unknown:
+                    continue
+                q = UNKNOWN_QUESTION
+            ans["question_text"] = q.get("text")
+            ans["max_score"] = q.get("max_score")
+            ans["rubric"] = q.get("rubric", [])
+
+
+question_index = QuestionIndex()
+
+
+class ExamCache:
+    """
+    Read-through, TTL-bounded LRU of exam documents for the hot paths (taking,
+    submitting, grading, viewing results). Edits and deletes bump the exam's
+    `version` field and invalidate the local entry; other processes notice
+    when their entry expires: a projection read of `version` then either
+    renews the entry or triggers a full reload.
+    """
+
+    def __init__(self):
+        self._exams = TTLCache(
+            lambda: settings.EXAM_CACHE_MAX_ENTRIES, lambda: settings.EXAM_CACHE_TTL_SECONDS
+        )  # exam_id -> exam
+
+    def _remember(self, exam_id: str, exam: dict):
+        self._exams.set(exam_id, exam)
+
+    async def get(self, exam_id, fresh: bool = False):
+        """
+        The exam (deleted ones included, check `is_deleted`), or None if it does not exist.
+        `fresh` always reads the database (and refreshes the entry), for callers that must
+        see an edit made in another process right away, e.g. a regrade after a rubric fix.
+        """
+        exam_id = str(exam_id)
+        entry = None if fresh else self._exams.peek(exam_id)
+        exam = None
+        if entry and entry[1]:
+            exam = self._exams.get(exam_id)
+        elif entry:
+            current = await db.db["exams"].find_one({"_id": ObjectId(exam_id)}, {"version": 1})
+            if current and current.get("version", 0) == entry[0].get("version", 0):
+                exam = entry[0]
+                self._remember(exam_id, exam)
+        if exam is None:
+            exam = await db.db["exams"].find_one({"_id": ObjectId(exam_id)})
+            if not exam:
+                self._exams.pop(exam_id, None)
+                return None
+            self._remember(exam_id, exam)
+        # Shallow copy so handlers can add display fields; nested questions are shared, read-only
+        return dict(exam)
+
+    def invalidate(self, exam_id):
+        """Call after changing an exam (together with bumping its `version`)."""
+        self._exams.pop(str(exam_id), None)
+
+
+exam_cache = ExamCache()
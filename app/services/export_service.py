@@ -0,0 +1,181 @@
+import csv
+import io
+import re
+import zipfile
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+from app.database import db
+
+EXPORT_BATCH_SIZE = 500  # rows per Mongo batch and per yielded chunk
+
+SUBMISSION_EXPORT_FIELDS = {
+    "exam_id": 1, "student_username": 1, "submitted_at": 1, "status": 1,
+    "total_score": 1, "teacher_total_score": 1,
+    "answers.question_id": 1, "answers.score": 1, "answers.teacher_score": 1
+}
+
+
+def _question_order(q_id: str):
+    match = re.match(r"^q(\d+)$", str(q_id))
+    return (0, int(match.group(1)), "") if match else (1, 0, str(q_id))
+
+
+def export_header(exams: list):
+    """Column titles plus the question ids behind the per-question columns (union over `exams`)."""
+    question_ids = sorted({q["id"] for exam in exams for q in exam.get("questions", [])}, key=_question_order)
+    header = ["Subject", "Exam", "Student", "Submitted At", "Status", "AI Score", "Teacher Score"]
+    for q_id in question_ids:
+        header += [f"{q_id} AI", f"{q_id} Teacher"]
+    return header, question_ids
+
+
+async def iter_result_rows(exams: list, question_ids: list):
+    """Yields one row per submission from a projected cursor, in exam then submission order."""
+    exam_info = {str(e["_id"]): (e.get("subject", ""), e.get("title", "")) for e in exams}
+    cursor = db.db["submissions"].find(
+        {"exam_id": {"$in": list(exam_info)}}, SUBMISSION_EXPORT_FIELDS
+    ).sort([("exam_id", 1), ("submitted_at", -1)]).batch_size(EXPORT_BATCH_SIZE)
+    async for sub in cursor:
+        subject, title = exam_info.get(sub.get("exam_id"), ("", ""))
+        submitted_at = sub.get("submitted_at")
+        row = [
+            subject,
+            title,
+            sub.get("student_username"),
+            submitted_at.strftime("%Y-%m-%d %H:%M") if submitted_at else "",
+            sub.get("status"),
+            sub.get("total_score"),
+            sub.get("teacher_total_score")
+        ]
+        answers = {a.get("question_id"): a for a in sub.get("answers", [])}
+        for q_id in question_ids:
+            ans = answers.get(q_id, {})
+            row += [ans.get("score"), ans.get("teacher_score")]
+        yield row
+
+
+async def stream_csv(header: list, rows):
+    """UTF-8 CSV with BOM (so Excel shows Thai text), encoded and yielded in chunks."""
+    buffer = io.StringIO()
+    buffer.write("\ufeff")
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    count = 0
+    async for row in rows:
+        writer.writerow(["" if v is None else v for v in row])
+        count += 1
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only, non-seekable target for zipfile; the generator drains it after each write."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data, self.chunks = b"".join(self.chunks), []
+        return data
+
+
+def _column_name(index: int) -> str:
+    name = ""
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        name = chr(65 + rem) + name
+    return name
+
+
+def _xlsx_row(number: int, values: list) -> str:
+    cells = []
+    for i, value in enumerate(values):
+        ref = f"{_column_name(i)}{number}"
+        if value is None or value == "":
+            continue
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append(f'<c r="{ref}"><v>{value}</v></c>')
+        else:
+            cells.append(f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{escape(str(value))}</t></is></c>')
+    return f'<row r="{number}">{"".join(cells)}</row>'
+
+
+_XLSX_STATIC_PARTS = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    "xl/workbook.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Results" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+
+async def stream_xlsx(header: list, rows):
+    """
+    Minimal single-sheet XLSX written straight into a streamed zip (inline strings,
+    no shared-string table), so memory stays constant regardless of the row count.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in _XLSX_STATIC_PARTS.items():
+            archive.writestr(name, content)
+        with archive.open("xl/worksheets/sheet1.xml", "w") as sheet:
+            sheet.write((
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                + _xlsx_row(1, header)
+            ).encode("utf-8"))
+            number = 1
+            async for row in rows:
+                number += 1
+                sheet.write(_xlsx_row(number, row).encode("utf-8"))
+                if number % EXPORT_BATCH_SIZE == 0:
+                    yield sink.drain()
+            sheet.write(b"</sheetData></worksheet>")
+        yield sink.drain()
+    yield sink.drain()
+
+
+EXPORT_FORMATS = {
+    "csv": (stream_csv, "text/csv; charset=utf-8", "csv"),
+    "xlsx": (stream_xlsx, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "xlsx"),
+}
+
+
+def content_disposition(name: str) -> str:
+    """Attachment header that survives Thai file names (RFC 5987 plus an ASCII fallback)."""
+    fallback = re.sub(r"[^A-Za-z0-9.-]+", "_", name).strip("_") or "export"
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(name)}"
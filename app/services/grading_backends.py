@@ -0,0 +1,264 @@
+import asyncio
+import hashlib
+import json
+import random
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+from app.config import settings
+from app.services.batch_planner import count_tokens
+from app.services.ttl_cache import TTLCache
+
+
+@dataclass
+class BackendResponse:
+    text: str
+    blocked: bool = False
+    prompt_tokens: int = 0
+    output_tokens: int = 0
+    cached_tokens: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.output_tokens
+
+
+# Structured-output schema for JSON mode: one object per graded item
+GRADING_RESPONSE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "id": {"type": "string"},
+            "score": {"type": "number"},
+            "justification": {"type": "string"},
+            "feedback": {"type": "string"},
+            "strengths": {"type": "string"},
+            "improvements": {"type": "string"}
+        },
+        "required": ["id", "score"]
+    }
+}
+
+
+def is_invalid_argument_error(e: Exception) -> bool:
+    """400-class rejection (e.g. content below the minimum cacheable size), as opposed to a transient failure."""
+    text = f"{type(e).__name__} {e}".lower()
+    return any(s in text for s in ("invalidargument", "400", "too small", "min_total_token_count", "not supported"))
+
+
+class GradingBackend:
+    """Interface of a model that turns a grading prompt into a JSON answer."""
+
+    name = "base"
+    model_name = "base"
+
+    async def generate(self, prompt: str, items: list, prefix: str = None) -> BackendResponse:
+        """
+        `items` are the grading items encoded in `prompt` (backends may ignore them).
+        `prefix` is the shared exam part of the prompt that goes before `prompt`;
+        backends with context caching can serve it from the cache.
+        """
+        raise NotImplementedError
+
+
+class GeminiBackend(GradingBackend):
+    name = "gemini"
+
+    def __init__(self, model_name: str = None):
+        self._genai = None
+        self._model = None
+        # ใช้ชื่อโมเดลที่แนะนำและเสถียรที่สุด
+        self.model_name = model_name or settings.GEMINI_MODEL
+        # prefix hash -> model bound to the cached content; recreated a little before the server-side TTL runs out
+        self._cached_models = TTLCache(
+            lambda: settings.PROMPT_TEMPLATE_CACHE_MAX_ENTRIES,
+            lambda: max(settings.GEMINI_CONTEXT_CACHE_TTL_SECONDS - 60, 0)
+        )
+        self._uncacheable = TTLCache(lambda: settings.PROMPT_TEMPLATE_CACHE_MAX_ENTRIES)  # prefix hash -> True
+        self._creating = {}  # prefix hash -> in-flight creation
+
+    @property
+    def genai(self):
+        """Lazy load google.generativeai and configure it."""
+        if self._genai is None:
+            print("DEBUG: Lazy loading google.generativeai...")
+            import google.generativeai as genai
+
+            api_key = settings.GEMINI_API_KEY.strip()
+            key_len = len(api_key)
+            print(f"DEBUG: Loading Gemini API Key. Length: {key_len}")
+
+            if key_len < 30:
+                print("WARNING: API Key looks too short! (Usually around 39 characters)")
+
+            genai.configure(api_key=api_key)
+            self._genai = genai
+        return self._genai
+
+    # JSON mode: the model must answer with an array matching the schema, no prose or fences
+    generation_config = {
+        "response_mime_type": "application/json",
+        "response_schema": GRADING_RESPONSE_SCHEMA,
+        "max_output_tokens": settings.GEMINI_MAX_OUTPUT_TOKENS
+    }
+
+    @property
+    def model(self):
+        """Lazy load the generative model."""
+        if self._model is None:
+            self._model = self.genai.GenerativeModel(self.model_name, generation_config=self.generation_config)
+        return self._model
+
+    async def _cached_model(self, prefix: str):
+        """
+        Model bound to a context cache holding `prefix`, created on first use per exam version.
+        Returns None when caching is disabled, the prefix is below the minimum cacheable size,
+        or the cache cannot be created right now (then the prefix is simply sent inline).
+        """
+        if not settings.GEMINI_CONTEXT_CACHE_ENABLED or count_tokens(prefix) < settings.GEMINI_CONTEXT_CACHE_MIN_TOKENS:
+            return None
+        key = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+        if self._uncacheable.get(key):
+            return None
+        model = self._cached_models.get(key)
+        if model is not None:
+            return model
+        # Concurrent chunks and workers grading the same exam share one (billed) cache creation
+        creating = self._creating.get(key)
+        if creating is None:
+            creating = asyncio.ensure_future(self._create_cached_model(key, prefix))
+            self._creating[key] = creating
+            creating.add_done_callback(lambda _: self._creating.pop(key, None))
+        return await asyncio.shield(creating)
+
+    async def _create_cached_model(self, key: str, prefix: str):
+        try:
+            model_name = self.model_name if self.model_name.startswith("models/") else f"models/{self.model_name}"
+            cached = await asyncio.to_thread(
+                self.genai.caching.CachedContent.create,
+                model=model_name,
+                display_name=f"exam-prompt-{key[:16]}",
+                contents=[prefix],
+                ttl=timedelta(seconds=settings.GEMINI_CONTEXT_CACHE_TTL_SECONDS)
+            )
+            model = self.genai.GenerativeModel.from_cached_content(cached, generation_config=self.generation_config)
+        except Exception as e:
+            if is_invalid_argument_error(e):
+                # Too small for this model or not supported: don't ask again for this prefix
+                print(f"Context cache not possible for {self.model_name}, sending the exam prompt inline: {e}")
+                self._uncacheable.set(key, True)
+            else:
+                # Transient (429, 5xx, network): inline this time, try again on a later call
+                print(f"Context cache creation failed for {self.model_name}, sending the exam prompt inline: {e}")
+            return None
+        self._cached_models.set(key, model)
+        return model
+
+    async def generate(self, prompt: str, items: list, prefix: str = None) -> BackendResponse:
+        model = await self._cached_model(prefix) if prefix else None
+        if model is not None:
+            response = await model.generate_content_async(prompt)
+        else:
+            # Shared prefix first, so implicit prefix caching can still apply
+            response = await self.model.generate_content_async((prefix or "") + prompt)
+        usage = getattr(response, "usage_metadata", None)
+        prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+        output_tokens = getattr(usage, "candidates_token_count", 0) or 0
+        cached_tokens = getattr(usage, "cached_content_token_count", 0) or 0
+        if not response.parts:
+            return BackendResponse("", blocked=True, prompt_tokens=prompt_tokens, cached_tokens=cached_tokens)
+        return BackendResponse(response.text, prompt_tokens=prompt_tokens, output_tokens=output_tokens, cached_tokens=cached_tokens)
+
+
+class MockBackend(GradingBackend):
+    """
+    Offline, deterministic stand-in for Gemini used for load tests and benchmarks.
+    Scores are derived from a hash of each answer; latency follows a log-normal
+    distribution and errors / malformed JSON are injected at configurable rates
+    from a seeded RNG, so runs are reproducible without network access.
+    """
+
+    name = "mock"
+    model_name = "mock-grader"
+
+    def __init__(self, seed: int = None):
+        self.random = random.Random(settings.MOCK_SEED if seed is None else seed)
+        self.calls = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.cached_tokens = 0
+        self._cached_prefixes = {}  # prefix hash -> expires_at, mimics context caching
+
+    def _latency(self) -> float:
+        median = settings.MOCK_LATENCY_MEDIAN_MS / 1000
+        return self.random.lognormvariate(0, settings.MOCK_LATENCY_SIGMA) * median
+
+    def _grade(self, item: dict, index: int) -> dict:
+        digest = hashlib.sha256(str(item.get("student_answer", "")).encode("utf-8")).digest()
+        max_score = item.get("max_score") or 0
+        result = {
+            "score": digest[0] % (int(max_score) + 1),
+            "justification": "ผลการตรวจจำลอง (mock backend)",
+            "feedback": "คำแนะนำจำลอง",
+            "strengths": "-",
+            "improvements": "-"
+        }
+        if item.get("item_id"):
+            result["id"] = item["item_id"]
+        return result
+
+    async def generate(self, prompt: str, items: list, prefix: str = None) -> BackendResponse:
+        self.calls += 1
+        await asyncio.sleep(self._latency())
+
+        roll = self.random.random()
+        if roll < settings.MOCK_RATE_LIMIT_RATE:
+            self.errors += 1
+            raise RuntimeError("429 Resource has been exhausted (mock quota)")
+        roll -= settings.MOCK_RATE_LIMIT_RATE
+        if roll < settings.MOCK_ERROR_RATE:
+            self.errors += 1
+            raise RuntimeError("503 Service unavailable (mock)")
+
+        prompt_tokens = (len(prefix or "") + len(prompt)) // 2
+        cached_tokens = 0
+        if prefix and settings.GEMINI_CONTEXT_CACHE_ENABLED:
+            key = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+            if self._cached_prefixes.get(key, 0) > time.monotonic():
+                cached_tokens = len(prefix) // 2
+            else:
+                self._cached_prefixes[key] = time.monotonic() + settings.GEMINI_CONTEXT_CACHE_TTL_SECONDS
+        # JSON mode: a bare array, as Gemini returns with response_mime_type=application/json
+        text = json.dumps([self._grade(item, i) for i, item in enumerate(items)], ensure_ascii=False)
+        if self.random.random() < settings.MOCK_MALFORMED_RATE:
+            # Output cut off mid-way (e.g. max output tokens reached)
+            text = text[:self.random.randint(1, max(1, len(text) - 1))]
+        output_tokens = len(text) // 2
+        self.prompt_tokens += prompt_tokens
+        self.output_tokens += output_tokens
+        self.cached_tokens += cached_tokens
+        return BackendResponse(text, prompt_tokens=prompt_tokens, output_tokens=output_tokens, cached_tokens=cached_tokens)
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "prompt_tokens": self.prompt_tokens,
+            "output_tokens": self.output_tokens,
+            "cached_tokens": self.cached_tokens
+        }
+
+
+BACKENDS = {
+    "gemini": GeminiBackend,
+    "mock": MockBackend,
+}
+
+
+def create_backend(name: str = None) -> GradingBackend:
+    name = (name or settings.GRADING_BACKEND).lower()
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown GRADING_BACKEND '{name}' (expected one of: {', '.join(BACKENDS)})")
+    return BACKENDS[name]()
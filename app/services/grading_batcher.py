@@ -0,0 +1,91 @@
+import asyncio
+from app.config import settings
+from app.services.ai_service import ai_service
+from app.services.batch_planner import batch_planner
+
+
+class GradingBatcher:
+    """
+    Micro-batching coalescer in front of AIService.grade_batch.
+    Answers from many submissions are collected for a short window (or until the
+    token/item budget is reached), graded in one Gemini call per exam with stable
+    item ids, and the parsed results are fanned back to each waiting caller.
+    """
+
+    def __init__(self):
+        self._pending = []
+        self._pending_tokens = 0
+        self._pending_output_tokens = 0
+        self._timer = None
+        self._seq = 0
+
+    async def grade(self, questions_data: list, context: dict = None):
+        """Same contract as AIService.grade_batch, but shares the model call with other callers."""
+        if not questions_data:
+            return []
+        if settings.GRADING_BATCH_WINDOW_MS <= 0:
+            return await ai_service.grade_batch(questions_data, context)
+
+        loop = asyncio.get_running_loop()
+        futures = []
+        for q in questions_data:
+            future = loop.create_future()
+            self._pending.append({"item": q, "future": future, "context": context})
+            # Questions usually travel in the exam prompt prefix, so only the answer counts here
+            self._pending_tokens += batch_planner.input_tokens(q, with_question=not q.get("prompt_version"))
+            self._pending_output_tokens += batch_planner.output_tokens(q)
+            futures.append(future)
+
+        if (self._pending_tokens >= settings.GRADING_BATCH_MAX_TOKENS
+                or self._pending_output_tokens >= settings.GRADING_MAX_OUTPUT_TOKENS_PER_CALL
+                or len(self._pending) >= settings.GRADING_BATCH_MAX_ITEMS):
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(settings.GRADING_BATCH_WINDOW_MS / 1000, self._flush)
+
+        return list(await asyncio.gather(*futures))
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        self._pending_tokens = self._pending_output_tokens = 0
+        if pending:
+            asyncio.create_task(self._grade_pending(pending))
+
+    async def _grade_pending(self, pending: list):
+        # One call per exam version, so each prompt starts with that exam's shared prefix
+        groups = {}
+        for entry in pending:
+            item = entry["item"]
+            groups.setdefault((item.get("exam_id"), item.get("prompt_version")), []).append(entry)
+        await asyncio.gather(*(self._grade_group(group) for group in groups.values()))
+
+    async def _grade_group(self, pending: list):
+        batch = []
+        for entry in pending:
+            self._seq += 1
+            # Stable ids let results be matched even if the model reorders them
+            batch.append({**entry["item"], "item_id": entry["item"].get("item_id") or f"i{self._seq}"})
+
+        contexts = [entry["context"] for entry in pending if entry["context"]]
+        context = contexts[0] if len(contexts) == 1 else {"batched": True, "items": len(batch), "contexts": contexts}
+        try:
+            results = await ai_service.grade_batch(batch, context)
+        except Exception as e:
+            for entry in pending:
+                if not entry["future"].done():
+                    entry["future"].set_exception(e)
+            return
+
+        for i, entry in enumerate(pending):
+            if entry["future"].done():
+                continue
+            if i < len(results):
+                entry["future"].set_result(results[i])
+            else:
+                entry["future"].set_exception(RuntimeError("Missing grading result for batched item"))
+
+
+grading_batcher = GradingBatcher()
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import unicodedata
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+from app.config import settings
+from app.database import db
+from app.services.ai_service import ai_service
+from app.services.ttl_cache import TTLCache
+
+
+def normalize_answer(text: str) -> str:
+    """Normalizes a student answer so trivially different copies share a cache entry."""
+    text = unicodedata.normalize("NFC", text or "")
+    return " ".join(text.split()).lower()
+
+
+def _rubric_for_key(rubric) -> list:
+    items = []
+    for r in rubric or []:
+        if hasattr(r, 'dict'): r = r.dict()
+        items.append([r.get("level", ""), r.get("score"), r.get("description", "")])
+    return items
+
+
+def grading_key(item: dict) -> str:
+    """Content hash of everything that can influence the grade of one answer."""
+    payload = json.dumps([
+        item.get("question_text"),
+        item.get("answer_key"),
+        _rubric_for_key(item.get("rubric")),
+        item.get("max_score"),
+        ai_service.model_name,
+        normalize_answer(item.get("student_answer"))
+    ], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class GradingCache:
+    """
+    Two-tier cache of AI grading results: an in-process LRU in front of the
+    `grading_cache` collection. Entries expire after GRADING_CACHE_TTL_SECONDS
+    (Mongo removes them through the TTL index registered in app.database).
+    """
+
+    def __init__(self):
+        self._lru = TTLCache(
+            lambda: settings.GRADING_CACHE_MAX_ENTRIES, lambda: settings.GRADING_CACHE_TTL_SECONDS
+        )  # key -> (result, exam_id, question_id)
+
+    @property
+    def collection(self):
+        return db.db["grading_cache"]
+
+    def _lru_get(self, key: str):
+        entry = self._lru.get(key)
+        return None if entry is None else entry[0]
+
+    def _lru_set(self, key: str, result: dict, exam_id=None, question_id=None):
+        self._lru.set(key, (result, exam_id, question_id))
+
+    async def get_many(self, items: list) -> list:
+        """Returns a cached result (or None) for each item."""
+        keys = [grading_key(item) for item in items]
+        results = [self._lru_get(k) for k in keys]
+        missing = list({k for k, r in zip(keys, results) if r is None})
+        if missing:
+            try:
+                docs = await self.collection.find(
+                    {"_id": {"$in": missing}, "expires_at": {"$gt": datetime.now()}},
+                    {"result": 1, "exam_id": 1, "question_id": 1}
+                ).to_list(len(missing))
+            except Exception as e:
+                print(f"Grading cache read error (Non-critical): {e}")
+                docs = []
+            found = {d["_id"]: d for d in docs}
+            for i, k in enumerate(keys):
+                if results[i] is None and k in found:
+                    doc = found[k]
+                    self._lru_set(k, doc["result"], doc.get("exam_id"), doc.get("question_id"))
+                    results[i] = doc["result"]
+        # Callers mutate results, so hand out copies
+        return [dict(r) if r is not None else None for r in results]
+
+    async def set_many(self, items: list, results: list):
+        """Stores successful results; grading errors are never cached."""
+        now = datetime.now()
+        docs = {}
+        for item, result in zip(items, results):
+            if not isinstance(result, dict) or result.get("grading_error"):
+                continue
+            key = grading_key(item)
+            value = {k: v for k, v in result.items() if k != "id"}
+            self._lru_set(key, value, item.get("exam_id"), item.get("question_id"))
+            docs[key] = {
+                "result": value,
+                "exam_id": item.get("exam_id"),
+                "question_id": item.get("question_id"),
+                "created_at": now,
+                "expires_at": now + timedelta(seconds=settings.GRADING_CACHE_TTL_SECONDS)
+            }
+        if not docs:
+            return
+        try:
+            await self.collection.bulk_write(
+                [UpdateOne({"_id": key}, {"$set": doc}, upsert=True) for key, doc in docs.items()],
+                ordered=False
+            )
+        except Exception as e:
+            print(f"Grading cache write error (Non-critical): {e}")
+
+    async def grade(self, questions_data: list, context: dict, grader) -> list:
+        """Serves cached grades and sends only the misses to `grader`."""
+        if not settings.GRADING_CACHE_ENABLED:
+            return await grader(questions_data, context)
+
+        results = await self.get_many(questions_data)
+        miss_idx = [i for i, r in enumerate(results) if r is None]
+        if miss_idx:
+            misses = [questions_data[i] for i in miss_idx]
+            fresh = await grader(misses, context)
+            await self.set_many(misses, fresh)
+            for i, result in zip(miss_idx, fresh):
+                results[i] = result
+        print(f"Grading cache: {len(questions_data) - len(miss_idx)} hits, {len(miss_idx)} misses.")
+        return results
+
+    async def invalidate_exam(self, exam_id: str, question_ids: list = None):
+        """Drops cached grades of an exam (optionally only some of its questions)."""
+        exam_id = str(exam_id)
+        for key, entry in self._lru.items():
+            if entry[1] == exam_id and (question_ids is None or entry[2] in question_ids):
+                self._lru.pop(key)
+        query = {"exam_id": exam_id}
+        if question_ids is not None:
+            query["question_id"] = {"$in": list(question_ids)}
+        try:
+            await self.collection.delete_many(query)
+        except Exception as e:
+            print(f"Grading cache invalidation error (Non-critical): {e}")
+
+
+grading_cache = GradingCache()
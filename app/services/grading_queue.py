@@ -0,0 +1,308 @@
+import asyncio
+import os
+import socket
+import traceback
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from app.config import settings
+from app.database import db
+from app.services.grading_service import grade_submission
+from app.services.metrics import registry, grading_queue_depth, grading_time_to_complete, grading_jobs
+
+# Job lifecycle: queued -> running -> done | failed (or back to queued for a retry)
+PENDING_STATUSES = ["queued", "running"]
+JOB_STATUSES = PENDING_STATUSES + ["done", "failed"]
+
+
+class GradingQueue:
+    """
+    Durable grading queue backed by the `grading_jobs` collection.
+    Workers claim jobs with a lease (visibility timeout); a job whose worker died
+    is picked up again once its lease expires, so grading survives restarts.
+    """
+
+    def __init__(self):
+        self._workers = []
+        self._watch_task = None
+        self._stopping = False
+        # Lazy initialization to avoid binding to an event loop at import time
+        self._wakeup = None
+        self.worker_prefix = f"{socket.gethostname()}:{os.getpid()}"
+
+    @property
+    def collection(self):
+        return db.db["grading_jobs"]
+
+    @property
+    def wakeup(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        return self._wakeup
+
+    def _enqueue_update(self, submission_id, action: str, context: dict, now: datetime):
+        """
+        Filter and update that upsert the submission's pending job. A job already
+        pending takes over `action` and `context` (so e.g. a teacher's regrade is not
+        lost behind a pending retry) and becomes available right away; a running one
+        runs once more with the new action when it finishes.
+        """
+        sid = str(submission_id)
+        return (
+            {"submission_id": sid, "status": {"$in": PENDING_STATUSES}},
+            {
+                "$set": {
+                    "action": action,
+                    "context": context or {},
+                    "available_at": now,
+                    "rerun": True,
+                    "updated_at": now
+                },
+                "$setOnInsert": {
+                    "submission_id": sid,
+                    "status": "queued",
+                    "attempts": 0,
+                    "lease_expires_at": None,
+                    "worker_id": None,
+                    "last_error": None,
+                    "created_at": now
+                }
+            }
+        )
+
+    async def enqueue(self, submission_id, action: str = "grade", context: dict = None):
+        """Adds a grading job, or hands the new action to the job already pending for this submission."""
+        query, update = self._enqueue_update(submission_id, action, context, datetime.now())
+        try:
+            await self.collection.update_one(query, update, upsert=True)
+        except DuplicateKeyError:
+            # Lost the insert race against a concurrent request (unique partial index):
+            # the pending job exists now, so the same update adopts it
+            await self.collection.update_one(query, update)
+        self.wakeup.set()
+
+    async def enqueue_many(self, submission_ids, action: str = "grade", context: dict = None) -> int:
+        """
+        Bulk version of enqueue in one round trip. Jobs already pending for a
+        submission take over `action` and `context`, so they count for this batch too.
+        Returns the number of newly created jobs.
+        """
+        now = datetime.now()
+        requests = [
+            UpdateOne(*self._enqueue_update(sid, action, context, now), upsert=True)
+            for sid in submission_ids
+        ]
+        if not requests:
+            return 0
+        try:
+            result = await self.collection.bulk_write(requests, ordered=False)
+            created = result.upserted_count
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(err.get("code") != 11000 for err in errors):
+                raise
+            # Lost an insert race against another enqueue (unique partial index): the
+            # pending job exists now, so the same update adopts it into this batch
+            created = e.details.get("nUpserted", 0)
+            await self.collection.bulk_write([requests[err["index"]] for err in errors], ordered=False)
+        self.wakeup.set()
+        return created
+
+    async def pending_submission_ids(self, submission_ids) -> set:
+        """Which of these submissions still have a queued or running job."""
+        ids = [str(sid) for sid in submission_ids]
+        if not ids:
+            return set()
+        cursor = self.collection.find(
+            {"submission_id": {"$in": ids}, "status": {"$in": PENDING_STATUSES}}, {"submission_id": 1})
+        return {job["submission_id"] async for job in cursor}
+
+    async def claim(self, worker_id: str):
+        """Atomically leases the oldest available job (or one whose lease expired)."""
+        now = datetime.now()
+        return await self.collection.find_one_and_update(
+            {"$or": [
+                {"status": "queued", "available_at": {"$lte": now}},
+                {"status": "running", "lease_expires_at": {"$lte": now}}
+            ]},
+            {
+                "$set": {
+                    "status": "running",
+                    "rerun": False,
+                    "worker_id": worker_id,
+                    "lease_expires_at": now + timedelta(seconds=settings.GRADING_LEASE_SECONDS),
+                    "updated_at": now
+                },
+                "$inc": {"attempts": 1}
+            },
+            sort=[("available_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _rerun_if_enqueued(self, job: dict, worker_id: str) -> bool:
+        """Requeues a job that was enqueued again while it ran, to run with the new action."""
+        now = datetime.now()
+        result = await self.collection.update_one(
+            {"_id": job["_id"], "worker_id": worker_id, "rerun": True},
+            {"$set": {
+                "status": "queued",
+                "rerun": False,
+                "attempts": 0,
+                "available_at": now,
+                "lease_expires_at": None,
+                "updated_at": now
+            }}
+        )
+        return result.modified_count > 0
+
+    async def complete(self, job: dict, worker_id: str):
+        result = await self.collection.update_one(
+            {"_id": job["_id"], "worker_id": worker_id, "rerun": {"$ne": True}},
+            {"$set": {
+                "status": "done",
+                "lease_expires_at": None,
+                "finished_at": datetime.now(),
+                "updated_at": datetime.now()
+            }}
+        )
+        if not result.matched_count and await self._rerun_if_enqueued(job, worker_id):
+            return
+        grading_jobs.inc(outcome="done")
+        if job.get("created_at"):
+            grading_time_to_complete.observe(
+                (datetime.now() - job["created_at"]).total_seconds(), action=job.get("action", "grade"))
+
+    async def fail(self, job: dict, worker_id: str, error: str, action: str = None):
+        """
+        Schedules a retry with exponential backoff, or gives up after max attempts.
+        `action` replaces the job's action for the retry (e.g. "retry_failed").
+        """
+        now = datetime.now()
+        give_up = job.get("attempts", 1) >= settings.GRADING_MAX_ATTEMPTS
+        if give_up:
+            update = {"status": "failed", "finished_at": now}
+        else:
+            delay = min(2 ** job.get("attempts", 1), 300)
+            update = {"status": "queued", "available_at": now + timedelta(seconds=delay)}
+            if action:
+                update["action"] = action
+        update.update({"last_error": error, "lease_expires_at": None, "updated_at": now})
+        result = await self.collection.update_one(
+            {"_id": job["_id"], "worker_id": worker_id, "rerun": {"$ne": True}}, {"$set": update})
+        if not result.matched_count and await self._rerun_if_enqueued(job, worker_id):
+            return
+        if give_up:
+            grading_jobs.inc(outcome="failed")
+            print(f"Grading job {job['_id']} failed permanently: {error}")
+        else:
+            grading_jobs.inc(outcome="retry")
+
+    async def release(self, job: dict, worker_id: str):
+        """Returns an interrupted job to the queue without counting the attempt."""
+        await self.collection.update_one(
+            {"_id": job["_id"], "worker_id": worker_id, "status": "running"},
+            {
+                "$set": {"status": "queued", "available_at": datetime.now(), "lease_expires_at": None},
+                "$inc": {"attempts": -1}
+            }
+        )
+
+    async def collect_metrics(self):
+        """Queue depth by status, read at scrape time."""
+        counts = {status: 0 for status in JOB_STATUSES}
+        async for row in self.collection.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]):
+            counts[row["_id"]] = row["count"]
+        for status, count in counts.items():
+            grading_queue_depth.set(count, status=status)
+
+    async def _extend_lease(self, job: dict, worker_id: str):
+        """Heartbeat so long-running grading is not mistaken for a dead worker."""
+        interval = max(settings.GRADING_LEASE_SECONDS / 3, 1)
+        while True:
+            await asyncio.sleep(interval)
+            await self.collection.update_one(
+                {"_id": job["_id"], "worker_id": worker_id, "status": "running"},
+                {"$set": {"lease_expires_at": datetime.now() + timedelta(seconds=settings.GRADING_LEASE_SECONDS)}}
+            )
+
+    async def _run(self, job: dict, worker_id: str):
+        heartbeat = asyncio.create_task(self._extend_lease(job, worker_id))
+        try:
+            failed_items = await grade_submission(job["submission_id"], job.get("action", "grade"))
+            if failed_items:
+                # Partial results are already saved; only the failed answers are retried
+                await self.fail(job, worker_id, f"{len(failed_items)} answer(s) failed: {', '.join(failed_items)}", action="retry_failed")
+            else:
+                await self.complete(job, worker_id)
+        except asyncio.CancelledError:
+            await asyncio.shield(self.release(job, worker_id))
+            raise
+        except Exception as e:
+            traceback.print_exc()
+            await self.fail(job, worker_id, str(e))
+        finally:
+            heartbeat.cancel()
+
+    async def _worker(self, worker_id: str):
+        while not self._stopping:
+            try:
+                job = await self.claim(worker_id)
+            except Exception as e:
+                print(f"Grading worker {worker_id} could not claim a job: {e}")
+                job = None
+
+            if job is None:
+                # Sleep until new work is enqueued in this process or the poll interval passes
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=settings.GRADING_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                continue
+
+            await self._run(job, worker_id)
+
+    async def _watch_jobs(self):
+        """Wakes idle workers when another process (e.g. the web server) enqueues a job."""
+        pipeline = [{"$match": {"operationType": "insert"}}]
+        while True:
+            try:
+                async with self.collection.watch(pipeline) as stream:
+                    async for _ in stream:
+                        self.wakeup.set()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Grading job change stream error (retrying): {e}")
+                await asyncio.sleep(5)
+
+    def start(self, workers: int = None):
+        """Starts the worker pool on the running event loop."""
+        if self._workers:
+            return
+        self._stopping = False
+        count = workers or settings.GRADING_WORKERS
+        self._workers = [
+            asyncio.create_task(self._worker(f"{self.worker_prefix}:{i}"))
+            for i in range(count)
+        ]
+        if settings.GRADING_QUEUE_CHANGE_STREAM:
+            self._watch_task = asyncio.create_task(self._watch_jobs())
+        print(f"Grading queue started with {count} workers.")
+
+    async def stop(self):
+        """Stops the workers; interrupted jobs are released back to the queue."""
+        if not self._workers:
+            return
+        self._stopping = True
+        tasks = self._workers + ([self._watch_task] if self._watch_task else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        self._watch_task = None
+        print("Grading queue stopped.")
+
+
+grading_queue = GradingQueue()
+registry.add_collector(grading_queue.collect_metrics)
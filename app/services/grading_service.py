@@ -0,0 +1,165 @@
+from bson import ObjectId
+from pymongo import ReturnDocument
+from app.database import db
+from app.services.grading_batcher import grading_batcher
+from app.services.grading_cache import grading_cache
+from app.services.prompt_templates import prompt_templates, current_question_version
+from app.services.events import submission_events
+from app.services.exam_service import question_index, exam_cache
+from app.services.stats_service import stats_service, stats_snapshot, STATS_FIELDS
+
+
+# Grading finished but some (or all) answers could not be graded; the queue retries them
+FAILED_STATUSES = ("partially_graded", "grading_failed")
+
+# Conditional writes of the results before giving the job back to the queue
+SAVE_ATTEMPTS = 5
+
+
+async def grade_submission(submission_id, action: str = "grade") -> list:
+    """
+    Grades (or regrades) one submission with the AI and stores the results.
+    Shared by the initial grading after submit and the teacher "regrade" action;
+    "regrade" only sends answers graded against an older version of their question
+    (or not graded successfully), "retry_failed" only the answers a previous run could not grade.
+    Returns the question ids that failed (empty when everything was graded).
+    """
+    sid = ObjectId(submission_id) if not isinstance(submission_id, ObjectId) else submission_id
+    submission = await db.db["submissions"].find_one({"_id": sid})
+    if not submission:
+        print(f"Grading skipped: submission {sid} not found.")
+        return []
+
+    # A regrade usually follows an exam edit, possibly made in another process: bypass the cache
+    exam = await exam_cache.get(submission["exam_id"], fresh=(action == "regrade"))
+    if not exam:
+        print(f"Grading skipped: exam {submission['exam_id']} not found.")
+        return []
+
+    # Questions, keys and rubrics go into the compiled exam prefix; items then only add the answers
+    prompt_version = await prompt_templates.ensure(exam)
+
+    questions = question_index.questions(exam)
+    answers_list = submission.get("answers", [])
+    batch_data = []
+    graded_answers = []
+    for ans in answers_list:
+        q_id = ans["question_id"]
+        if action == "retry_failed" and (not ans.get("grading_error") or ans.get("teacher_score") is not None):
+            # Failed answers the teacher has scored by hand are settled; don't grade them behind their back
+            continue
+        original_q = questions.get(q_id)
+        if original_q:
+            version = current_question_version(original_q)
+            if (action == "regrade" and ans.get("question_version") == version
+                    and not ans.get("grading_error") and ans.get("score") is not None):
+                continue
+            graded_answers.append((ans, version))
+            batch_data.append({
+                "item_id": f"{sid}:{q_id}",
+                "exam_id": submission["exam_id"],
+                "question_id": q_id,
+                "prompt_version": prompt_version,
+                "question_text": original_q["text"],
+                "student_answer": ans["answer_text"],
+                "max_score": original_q["max_score"],
+                "answer_key": original_q.get("answer_key"),
+                "rubric": original_q.get("rubric")
+            })
+
+    if action in ("regrade", "retry_failed") and not batch_data:
+        # Every answer is current (or scored by the teacher); keep scores, status and the review as they are
+        print(f"Grading ({action}) of {sid} skipped: nothing left for the AI to grade.")
+        return []
+
+    results = {}
+    if batch_data:
+        # Duplicate answers come from the cache; the rest are coalesced with
+        # answers from other submissions into shared Gemini calls
+        graded = await grading_cache.grade(batch_data, {
+            "student": submission["student_username"],
+            "exam_id": submission["exam_id"],
+            "exam": exam.get("title"),
+            "action": action
+        }, grading_batcher.grade)
+        results = {ans["question_id"]: (res, version) for (ans, version), res in zip(graded_answers, graded)}
+
+    # The model call takes seconds; a teacher may have saved a review meanwhile. The write is
+    # conditional on the revision that was read, and on a conflict the AI results are merged
+    # into a fresh read instead of overwriting the teacher's scores and status.
+    for _ in range(SAVE_ATTEMPTS):
+        answers_list, failed_items = _merge_results(submission.get("answers", []), results, action)
+        total_score = sum(ans["score"] for ans in answers_list if isinstance(ans.get("score"), (int, float)))
+        if submission.get("status") == "reviewed":
+            # AI scores are refreshed, but a teacher review is never downgraded
+            status = "reviewed"
+        elif not failed_items:
+            status = "graded"
+        elif any(ans.get("score") is not None for ans in answers_list):
+            status = "partially_graded"
+        else:
+            status = "grading_failed"
+
+        # Submissions without gradable answers are still closed out so they never stay "submitted"
+        replaced = await db.db["submissions"].find_one_and_update(
+            {"_id": sid, "revision": submission.get("revision")},
+            {
+                "$set": {
+                    "answers": answers_list,
+                    "total_score": total_score,
+                    "status": status,
+                    "failed_items": failed_items
+                },
+                "$inc": {"revision": 1}
+            },
+            projection={k: 1 for k in STATS_FIELDS},
+            return_document=ReturnDocument.BEFORE
+        )
+        if replaced:
+            break
+        submission = await db.db["submissions"].find_one({"_id": sid})
+        if not submission:
+            print(f"Grading of {sid} discarded: the submission was deleted meanwhile.")
+            return []
+    else:
+        # The queue retries the job against the then current document
+        raise RuntimeError(f"Submission {sid} kept changing while its grades were being saved")
+
+    # Delta from the document actually replaced, not the snapshot read before grading
+    before = stats_snapshot(replaced)
+    await stats_service.record_change(before, {**before, "total_score": total_score, "status": status})
+    submission_events.publish(sid, status)
+    if failed_items:
+        print(f"Grading of {sid}: {len(failed_items)} answer(s) failed ({status}).")
+    return failed_items
+
+
+def _merge_results(answers: list, results: dict, action: str):
+    """
+    Copies the AI results onto `answers` (by question id) and returns them with the ids
+    that failed in this run. Teacher fields are left alone; with "retry_failed" an answer
+    the teacher has scored since the run started keeps its state.
+    """
+    failed_items = []
+    for ans in answers:
+        graded = results.get(ans.get("question_id"))
+        if graded is None or (action == "retry_failed" and ans.get("teacher_score") is not None):
+            continue
+        res, version = graded
+        ans.update({
+            "score": res.get("score"),
+            "justification": res.get("justification"),
+            "feedback": res.get("feedback"),
+            "strengths": res.get("strengths"),
+            "improvements": res.get("improvements")
+        })
+        if res.get("grading_error"):
+            # No score rather than a silent zero; the queue retries this answer
+            ans.update({"grading_error": True, "grading_error_message": res.get("error")})
+            failed_items.append(ans["question_id"])
+        else:
+            # The question version this grade belongs to, so a later regrade can skip it
+            ans["question_version"] = version
+            ans.pop("grading_error", None)
+            ans.pop("grading_error_message", None)
+    return answers, failed_items
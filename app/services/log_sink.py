@@ -0,0 +1,117 @@
+import asyncio
+import random
+from pymongo.errors import BulkWriteError
+from app.config import settings
+from app.database import db
+from app.services.metrics import Counter, Gauge
+
+log_entries_dropped = Counter("log_entries_dropped_total", "Log entries dropped or sampled out under pressure.", ("collection",))
+log_entries_written = Counter("log_entries_written_total", "Log entries written to MongoDB.", ("collection",))
+log_buffer_size = Gauge("log_buffer_entries", "Log entries waiting to be written.", ("collection",))
+
+
+class LogSink:
+    """
+    Buffers log documents (ai_logs, audit_logs) in memory and writes them with
+    insert_many from a background task, so request and grading paths never wait
+    on a log insert. Flushes every LOG_FLUSH_INTERVAL_SECONDS or once
+    LOG_FLUSH_BATCH_SIZE entries are waiting, and once more on shutdown.
+
+    The buffer is bounded: past half of LOG_BUFFER_MAX_ENTRIES only a
+    LOG_SAMPLE_RATE sample of routine entries is kept, and when full they are
+    dropped. Entries written with `keep=True` (audit trail, failures) are never
+    sampled and are retried after a failed write; they are only dropped once
+    the buffer is full while MongoDB stays unavailable.
+    """
+
+    def __init__(self):
+        self._buffers = {}  # collection -> [(doc, keep)]
+        self._task = None
+        self._stopping = False
+        # Lazy initialization to avoid binding to an event loop at import time
+        self._wakeup = None
+
+    @property
+    def wakeup(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        return self._wakeup
+
+    def _pending(self) -> int:
+        return sum(len(b) for b in self._buffers.values())
+
+    def write(self, collection: str, doc: dict, keep: bool = False):
+        """Queues `doc` for `collection`; never blocks."""
+        if not keep:
+            pending = self._pending()
+            if pending >= settings.LOG_BUFFER_MAX_ENTRIES or (
+                    pending >= settings.LOG_BUFFER_MAX_ENTRIES // 2 and random.random() >= settings.LOG_SAMPLE_RATE):
+                log_entries_dropped.inc(collection=collection)
+                return
+            if pending >= settings.LOG_BUFFER_MAX_ENTRIES // 2:
+                # Kept as a sample: record the rate so counts can be scaled back up
+                doc = {**doc, "sample_rate": settings.LOG_SAMPLE_RATE}
+        buffer = self._buffers.setdefault(collection, [])
+        buffer.append((doc, keep))
+        log_buffer_size.set(len(buffer), collection=collection)
+        if len(buffer) >= settings.LOG_FLUSH_BATCH_SIZE:
+            self.wakeup.set()
+
+    async def flush(self, collection: str = None):
+        """Writes everything buffered (for one collection, or all of them)."""
+        names = [collection] if collection else list(self._buffers)
+        for name in names:
+            entries, self._buffers[name] = self._buffers.get(name, []), []
+            log_buffer_size.set(0, collection=name)
+            if not entries:
+                continue
+            try:
+                await db.db[name].insert_many([doc for doc, _ in entries], ordered=False)
+                log_entries_written.inc(len(entries), collection=name)
+            except Exception as e:
+                if isinstance(e, BulkWriteError):
+                    # Everything else was inserted; duplicate keys mean an earlier attempt already wrote the entry
+                    failed = {err["index"] for err in e.details.get("writeErrors", []) if err.get("code") != 11000}
+                    written = len(entries) - len(e.details.get("writeErrors", []))
+                    log_entries_written.inc(written, collection=name)
+                else:
+                    failed = set(range(len(entries)))
+                # Keep failed entries that must not be lost for the next flush; routine ones are dropped
+                kept = [(doc, keep) for i, (doc, keep) in enumerate(entries) if keep and i in failed]
+                retained = kept + self._buffers.get(name, [])
+                overflow = max(len(retained) - settings.LOG_BUFFER_MAX_ENTRIES, 0)
+                if overflow:
+                    # Bounded even for kept entries while the database stays unavailable; oldest go first
+                    retained = retained[overflow:]
+                self._buffers[name] = retained
+                log_buffer_size.set(len(retained), collection=name)
+                log_entries_dropped.inc(len(failed) - len(kept) + overflow, collection=name)
+                if failed:
+                    print(f"Log flush to {name} failed ({len(failed)} of {len(entries)} entries, {len(kept)} kept for retry): {e}")
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=settings.LOG_FLUSH_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops the background task and writes whatever is still buffered."""
+        if self._task:
+            # Let an in-progress flush finish instead of cancelling it mid-write
+            self._stopping = True
+            self.wakeup.set()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+
+log_sink = LogSink()
@@ -0,0 +1,246 @@
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+from pymongo import monitoring
+
+# Latency buckets in seconds: page renders and Mongo ops at the low end, Gemini calls at the top
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra: dict = None) -> str:
+    pairs = list(zip(names, values)) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Updated from pymongo's monitoring threads as well as the event loop
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def samples(self) -> list:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{labels} {_format_value(value)}" for name, labels, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> list:
+        with self._lock:
+            return [(self.name, _format_labels(self.labelnames, k), v) for k, v in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self) -> list:
+        with self._lock:
+            return [(self.name, _format_labels(self.labelnames, k), v) for k, v in sorted(self._values.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._values = {}  # label key -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            data = self._values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+                    break
+            data[-2] += value
+            data[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> list:
+        out = []
+        with self._lock:
+            for key, data in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, data):
+                    cumulative += count
+                    out.append((f"{self.name}_bucket", _format_labels(self.labelnames, key, {"le": _format_value(bound)}), cumulative))
+                out.append((f"{self.name}_sum", _format_labels(self.labelnames, key), data[-2]))
+                out.append((f"{self.name}_count", _format_labels(self.labelnames, key), data[-1]))
+        return out
+
+
+class MetricsRegistry:
+    """
+    Minimal Prometheus text-format registry (no client library needed).
+    Collectors are async callbacks run at scrape time, e.g. to read the queue depth.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric: _Metric):
+        self._metrics.append(metric)
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    async def render(self) -> str:
+        for collector in self._collectors:
+            try:
+                await collector()
+            except Exception as e:
+                print(f"Metrics collector error (Non-critical): {e}")
+        return "\n".join(m.render() for m in self._metrics) + "\n"
+
+
+registry = MetricsRegistry()
+
+# HTTP
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "Request latency by route template.", ("method", "route", "status"))
+
+# Gemini / grading backend
+gemini_call_duration = Histogram(
+    "gemini_call_duration_seconds", "Latency of grading model calls.", ("backend", "outcome"))
+gemini_tokens = Counter("gemini_tokens_total", "Tokens reported by the grading model.", ("kind",))
+gemini_retries = Counter("gemini_retries_total", "Grading calls repeated after a failure (retries and bisection).")
+gemini_errors = Counter("gemini_errors_total", "Failed grading calls by kind.", ("kind",))
+gemini_items = Counter("gemini_items_total", "Graded items by result.", ("result",))
+gemini_slot_wait = Histogram(
+    "gemini_slot_wait_seconds", "Time spent waiting for concurrency, RPM and TPM capacity before a call.")
+gemini_concurrency_limit = Gauge("gemini_concurrency_limit", "Current adaptive concurrency limit for model calls.")
+
+# Grading queue
+grading_queue_depth = Gauge("grading_queue_depth", "Grading jobs by status.", ("status",))
+grading_time_to_complete = Histogram(
+    "grading_time_to_complete_seconds", "Time from enqueue to a finished grading job.", ("action",))
+grading_jobs = Counter("grading_jobs_total", "Processed grading jobs by outcome.", ("outcome",))
+
+# MongoDB
+mongo_operation_duration = Histogram(
+    "mongo_operation_duration_seconds", "MongoDB command latency.", ("command", "collection", "outcome"))
+
+# Event loop
+event_loop_lag = Histogram(
+    "event_loop_lag_seconds", "How late the event loop wakes up from a short sleep.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every MongoDB command via pymongo's command monitoring."""
+
+    IGNORED = {"hello", "ismaster", "isMaster", "ping", "saslStart", "saslContinue", "endSessions"}
+
+    def __init__(self):
+        self._collections = {}  # (connection, request_id) -> collection name
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        if event.command_name in self.IGNORED:
+            return
+        collection = event.command.get(event.command_name)
+        with self._lock:
+            self._collections[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else ""
+
+    def _finish(self, event, outcome: str):
+        with self._lock:
+            collection = self._collections.pop((event.connection_id, event.request_id), None)
+        if collection is None:
+            return
+        mongo_operation_duration.observe(
+            event.duration_micros / 1e6, command=event.command_name, collection=collection, outcome=outcome)
+
+    def succeeded(self, event):
+        self._finish(event, "ok")
+
+    def failed(self, event):
+        self._finish(event, "error")
+
+
+mongo_command_metrics = MongoCommandMetrics()
+
+
+class LoopLagMonitor:
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            event_loop_lag.observe(max(time.perf_counter() - started - self.interval, 0))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+loop_lag_monitor = LoopLagMonitor()
@@ -0,0 +1,145 @@
+import hashlib
+import json
+from datetime import datetime
+from bson import ObjectId
+from app.config import settings
+from app.database import db
+from app.services.exam_service import exam_cache
+from app.services.ttl_cache import TTLCache
+
+GRADER_INSTRUCTIONS = """
+คุณคือระบบผู้เชี่ยวชาญในการตรวจข้อสอบอัตนัย (Subjective Exam Grader)
+จงประเมินคำตอบของนักเรียนทีละข้อตามข้อมูลที่กำหนดให้ โดยให้คะแนนอย่างเที่ยงตรงตามเกณฑ์
+"""
+
+GRADING_RULES = """
+[กฎการตรวจ]
+1. ประเมินความถูกต้องตามหลักวิชาการและเกณฑ์ที่ให้มา
+2. ให้คะแนนสุทธิ [0 ถึง คะแนนเต็ม] เท่านั้น
+3. สำหรับแต่ละข้อ จงระบุจุดแข็ง (Strengths) และสิ่งที่ควรปรับปรุง (Improvements)
+
+[รูปแบบการตอบกลับ (Strict JSON Array)]
+จงตอบกลับเป็น JSON Array ของอ็อบเจกต์ ข้อละหนึ่งอ็อบเจกต์ โดยระบุ "id" ให้ตรงกับรหัสรายการของข้อนั้น ดังนี้:
+[
+    {
+        "id": "[รหัสรายการของข้อนั้น]",
+        "score": [คะแนนข้อ 1],
+        "justification": "[เหตุผลสั้นๆ]",
+        "feedback": "[คำแนะนำรวม]",
+        "strengths": "[จุดเด่น]",
+        "improvements": "[จุดที่ควรแก้]"
+    },
+    ...
+]
+"""
+
+
+# Changes whenever the fixed parts of the prompt change, so stored templates get recompiled once
+TEMPLATE_FORMAT = hashlib.sha256((GRADER_INSTRUCTIONS + GRADING_RULES).encode("utf-8")).hexdigest()[:8]
+
+
+def format_rubric(rubric) -> str:
+    if not rubric:
+        return ""
+    text = "\n[เกณฑ์ Rubric]\n"
+    for item in rubric:
+        if hasattr(item, 'dict'): item = item.dict()
+        text += f"- {item.get('score')} คะแนน: {item.get('description')}\n"
+    return text
+
+
+def question_version(question: dict) -> str:
+    """Content hash of the parts of a question that affect grading (text, key, max score, rubric)."""
+    rubric = []
+    for r in question.get("rubric") or []:
+        if hasattr(r, 'dict'): r = r.dict()
+        rubric.append([r.get("level", ""), r.get("score"), r.get("description", "")])
+    payload = json.dumps(
+        [question.get("text"), question.get("answer_key"), question.get("max_score"), rubric],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def current_question_version(question: dict) -> str:
+    """Stored version, or the hash for exams saved before questions carried one."""
+    return question.get("version") or question_version(question)
+
+
+def compile_exam_prompt(exam: dict) -> dict:
+    """
+    Builds the part of the grading prompt that is identical for every student of an exam:
+    instructions, all questions with answer keys and rubrics, rules and output format.
+    Per-call prompts then only append the student answers, which keeps the shared prefix
+    first so it can be served from the model's context cache.
+    """
+    questions_prompt = ""
+    for q in exam.get("questions", []):
+        questions_prompt += f"""
+--- ข้อสอบ {q['id']} ---
+โจทย์: {q['text']}
+แนวคำตอบ: {q.get('answer_key') or 'ไม่ได้ระบุ'}
+คะแนนเต็ม: {q['max_score']}
+{format_rubric(q.get('rubric'))}"""
+
+    text = f"""{GRADER_INSTRUCTIONS}
+[วิชา] {exam.get('subject', '')}
+[ชุดข้อสอบ] {exam.get('title', '')}
+
+[ข้อมูลข้อสอบ]
+{questions_prompt}
+{GRADING_RULES}
+[คำตอบของนักเรียนที่ต้องตรวจ]
+แต่ละรายการระบุรหัสรายการ (id) และรหัสข้อสอบที่ตอบ ให้ตรวจตามโจทย์และเกณฑ์ของข้อสอบนั้น
+"""
+    return {
+        "version": hashlib.sha256(text.encode("utf-8")).hexdigest()[:16],
+        "format": TEMPLATE_FORMAT,
+        "text": text,
+        "compiled_at": datetime.now()
+    }
+
+
+class PromptTemplates:
+    """
+    Compiled exam prompt prefixes, stored on the exam as `prompt_template`
+    and kept in a small in-process LRU keyed by (exam_id, version).
+    """
+
+    def __init__(self):
+        self._templates = TTLCache(lambda: settings.PROMPT_TEMPLATE_CACHE_MAX_ENTRIES)  # (exam_id, version) -> prefix text
+
+    def _remember(self, exam_id: str, version: str, text: str):
+        self._templates.set((exam_id, version), text)
+
+    async def ensure(self, exam: dict) -> str:
+        """
+        Returns the current template version of `exam`. Creating and editing an exam store
+        its template, so only exams saved before templates existed (or before the last
+        change of the fixed prompt parts) are compiled here.
+        """
+        exam_id = str(exam["_id"])
+        template = exam.get("prompt_template")
+        if not template or template.get("format") != TEMPLATE_FORMAT:
+            template = compile_exam_prompt(exam)
+            await db.db["exams"].update_one({"_id": exam["_id"]}, {"$set": {"prompt_template": template}})
+            exam["prompt_template"] = template
+            exam_cache.invalidate(exam_id)
+        if self._templates.get((exam_id, template["version"])) is None:
+            self._remember(exam_id, template["version"], template["text"])
+        return template["version"]
+
+    async def get(self, exam_id: str, version: str):
+        """Prefix text for this exam version, or None if the exam has been edited since."""
+        text = self._templates.get((exam_id, version))
+        if text is not None:
+            return text
+        exam = await db.db["exams"].find_one({"_id": ObjectId(exam_id)}, {"prompt_template": 1})
+        stored = (exam or {}).get("prompt_template") or {}
+        if stored.get("version") != version:
+            return None
+        self._remember(exam_id, version, stored["text"])
+        return stored["text"]
+
+
+prompt_templates = PromptTemplates()
@@ -0,0 +1,148 @@
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager
+from app.config import settings
+from app.services.metrics import gemini_slot_wait, gemini_concurrency_limit
+
+
+class TokenBucket:
+    """Refills `per_minute` units per minute; callers wait until enough units are available."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = max(per_minute, 1)
+        self.rate = self.capacity / 60.0
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        # Lazy initialization to avoid binding to an event loop at import time
+        self._lock = None
+
+    @property
+    def lock(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1):
+        # Requests larger than the bucket would never fit; let them through on a full bucket
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def adjust(self, delta: float):
+        """Corrects a reservation once the real usage is known (may go into debt)."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - delta)
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD concurrency limit: grows by ~1 per window of healthy calls and
+    halves on throttling (429 / quota) errors.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int, target_latency: float):
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._cond = None
+
+    @property
+    def cond(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def acquire(self):
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self):
+        async with self.cond:
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+    def on_success(self, latency: float):
+        if latency <= self.target_latency:
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def on_overload(self):
+        # A burst of 429s from calls already in flight counts as one congestion signal
+        now = time.monotonic()
+        if now - self._last_decrease < self.target_latency:
+            return
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit / 2)
+        print(f"  Rate limited: Gemini concurrency reduced to {int(self.limit)}")
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    text = f"{type(e).__name__} {e}".lower()
+    return any(s in text for s in ("429", "resourceexhausted", "resource has been exhausted", "quota", "rate limit"))
+
+
+def backoff_delay(attempt: int) -> float:
+    """Exponential backoff with full jitter."""
+    cap = min(settings.GEMINI_BACKOFF_MAX_SECONDS, settings.GEMINI_BACKOFF_BASE_SECONDS * (2 ** attempt))
+    return random.uniform(0, cap)
+
+
+class GeminiRateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute buckets plus adaptive concurrency, shared by
+    all grading paths of this process. The buckets hold this process's GEMINI_QUOTA_SHARE
+    of the project quota, since every grading process runs its own limiter.
+    """
+
+    def __init__(self):
+        share = min(max(settings.GEMINI_QUOTA_SHARE, 0.0), 1.0)
+        self.requests = TokenBucket(settings.GEMINI_RPM * share)
+        self.tokens = TokenBucket(settings.GEMINI_TPM * share)
+        self.concurrency = AdaptiveConcurrency(
+            settings.GEMINI_INITIAL_CONCURRENCY,
+            settings.GEMINI_MIN_CONCURRENCY,
+            settings.GEMINI_MAX_CONCURRENCY,
+            settings.GEMINI_TARGET_LATENCY_SECONDS
+        )
+
+    @asynccontextmanager
+    async def slot(self, estimated_tokens: int):
+        started = time.perf_counter()
+        await self.concurrency.acquire()
+        try:
+            await self.requests.acquire(1)
+            await self.tokens.acquire(estimated_tokens)
+            gemini_slot_wait.observe(time.perf_counter() - started)
+            yield
+        finally:
+            await self.concurrency.release()
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int):
+        if actual_tokens:
+            self.tokens.adjust(actual_tokens - estimated_tokens)
+
+    def on_success(self, latency: float):
+        self.concurrency.on_success(latency)
+        gemini_concurrency_limit.set(int(self.concurrency.limit))
+
+    def on_error(self, e: Exception):
+        if is_rate_limit_error(e):
+            self.concurrency.on_overload()
+            gemini_concurrency_limit.set(int(self.concurrency.limit))
+
+
+gemini_limiter = GeminiRateLimiter()
@@ -0,0 +1,88 @@
+from datetime import datetime
+from bson import ObjectId
+from app.database import db
+from app.services.grading_queue import grading_queue
+from app.services.prompt_templates import current_question_version
+
+
+class RegradeService:
+    """
+    Bulk regrade of a whole exam (e.g. after a rubric fix).
+    Each affected submission gets one job on the durable grading queue, tagged with the
+    run id; the regular workers then grade them at the queue's pace, the batcher
+    coalesces their answers into shared calls and the Gemini limiter throttles
+    against quota. Only submissions with an answer graded against an older
+    question version (or not graded at all) are queued, and grade_submission
+    then re-sends just those answers. Progress is read back from the jobs of the run.
+    """
+
+    @property
+    def collection(self):
+        return db.db["regrade_runs"]
+
+    async def start(self, exam: dict, username: str) -> dict:
+        exam_id = str(exam["_id"])
+        run = {
+            "_id": ObjectId(),
+            "exam_id": exam_id,
+            "created_by": username,
+            "total": 0,
+            "created_at": datetime.now()
+        }
+        stale = [
+            {"question_id": q["id"], "question_version": {"$ne": current_question_version(q)}}
+            for q in exam.get("questions", [])
+        ]
+        cursor = db.db["submissions"].find({
+            "exam_id": exam_id,
+            "answers": {"$elemMatch": {"$or": stale + [{"grading_error": True}, {"score": None}]}}
+        }, {"_id": 1})
+        submission_ids = [sub["_id"] async for sub in cursor]
+        run["total"] = len(submission_ids)
+        await self.collection.insert_one(run)
+        await grading_queue.enqueue_many(
+            submission_ids, action="regrade",
+            context={"exam_id": exam_id, "exam": exam.get("title"), "bulk_id": str(run["_id"])}
+        )
+        print(f"Bulk regrade {run['_id']} of exam {exam_id}: {run['total']} submissions queued by {username}.")
+        return run
+
+    async def progress(self, exam_id: str) -> dict:
+        """Counts for the latest run of an exam, with an ETA from the rate so far."""
+        run = await self.collection.find_one({"exam_id": exam_id}, sort=[("created_at", -1)])
+        if not run:
+            return None
+
+        counts = {}
+        async for row in grading_queue.collection.aggregate([
+            {"$match": {"context.bulk_id": str(run["_id"])}},
+            {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+        ]):
+            counts[row["_id"]] = row["count"]
+        done = counts.get("done", 0)
+        failed = counts.get("failed", 0)
+        remaining = max(run["total"] - done - failed, 0)
+
+        elapsed = (datetime.now() - run["created_at"]).total_seconds()
+        finished = done + failed
+        eta = None
+        if remaining == 0:
+            eta = 0
+        elif finished:
+            eta = round(elapsed / finished * remaining)
+
+        return {
+            "run_id": str(run["_id"]),
+            "exam_id": exam_id,
+            "started_at": run["created_at"].strftime("%Y-%m-%d %H:%M:%S"),
+            "total": run["total"],
+            "done": done,
+            "failed": failed,
+            "running": counts.get("running", 0),
+            "remaining": remaining,
+            "eta_seconds": eta,
+            "finished": remaining == 0
+        }
+
+
+regrade_service = RegradeService()
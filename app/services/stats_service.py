@@ -0,0 +1,146 @@
+from datetime import datetime
+from pymongo import ReplaceOne, UpdateOne
+from app.database import db
+
+GRADED_STATUSES = ("graded", "reviewed")
+STATS_FIELDS = ("student_username", "exam_id", "status", "total_score", "teacher_total_score")
+STATS_KINDS = ["student", "exam", "exam_student"]
+REBUILD_BATCH_SIZE = 1000
+
+
+def stats_snapshot(submission: dict) -> dict:
+    """The subset of a submission that its statistics depend on."""
+    return {k: submission[k] for k in STATS_FIELDS if k in submission}
+
+
+def effective_score(submission: dict) -> float:
+    """Teacher score when reviewed, otherwise the AI score (same rule as the performance pages)."""
+    score = submission.get("teacher_total_score", submission.get("total_score", 0))
+    return score or 0
+
+
+def _contribution(submission: dict):
+    if not submission:
+        return 0, 0, 0
+    if submission.get("status") in GRADED_STATUSES:
+        return 1, 1, effective_score(submission)
+    return 1, 0, 0
+
+
+def _stat_keys(submission: dict) -> list:
+    username = submission["student_username"]
+    exam_id = str(submission["exam_id"])
+    return [
+        ({"_id": f"student:{username}"}, {"kind": "student", "username": username}),
+        ({"_id": f"exam:{exam_id}"}, {"kind": "exam", "exam_id": exam_id}),
+        ({"_id": f"exam_student:{exam_id}:{username}"}, {"kind": "exam_student", "exam_id": exam_id, "username": username}),
+    ]
+
+
+class StatsService:
+    """
+    Materialized per-student and per-exam statistics in the `stats` collection.
+    Every change to a submission is applied as a $inc of its contribution delta,
+    so the performance pages read a handful of documents instead of scanning submissions.
+    """
+
+    @property
+    def collection(self):
+        return db.db["stats"]
+
+    async def record_change(self, before: dict = None, after: dict = None):
+        """Applies the difference between a submission's old and new state (None = absent)."""
+        doc = after or before
+        if not doc:
+            return
+        b, a = _contribution(before), _contribution(after)
+        inc = {
+            "submissions": a[0] - b[0],
+            "graded_count": a[1] - b[1],
+            "total_score": a[2] - b[2]
+        }
+        if not any(inc.values()):
+            return
+        try:
+            await self.collection.bulk_write([
+                UpdateOne(key, {"$inc": inc, "$set": labels}, upsert=True)
+                for key, labels in _stat_keys(doc)
+            ], ordered=False)
+        except Exception as e:
+            # Drift is repaired by scripts/rebuild_stats.py
+            print(f"Stats update error (Non-critical): {e}")
+
+    async def student_performance(self) -> list:
+        docs = await self.collection.find({"kind": "student"}).sort("username", 1).to_list(None)
+        return [{
+            "username": d["username"],
+            "submissions": d.get("submissions", 0),
+            "avg_score": round(d["total_score"] / d["graded_count"], 2) if d.get("graded_count") else 0
+        } for d in docs]
+
+    async def student_stats_for_exams(self, exam_ids: list) -> dict:
+        """Per-student submission count and average score over the given exams."""
+        docs = await self.collection.find({"kind": "exam_student", "exam_id": {"$in": exam_ids}}).to_list(None)
+        totals = {}
+        for d in docs:
+            t = totals.setdefault(d["username"], {"count": 0, "graded_count": 0, "total_score": 0})
+            t["count"] += d.get("submissions", 0)
+            t["graded_count"] += d.get("graded_count", 0)
+            t["total_score"] += d.get("total_score", 0)
+        return {
+            username: {
+                "count": t["count"],
+                "avg_score": round(t["total_score"] / t["graded_count"], 2) if t["graded_count"] else 0
+            }
+            for username, t in sorted(totals.items())
+        }
+
+    async def rebuild(self):
+        """
+        Recomputes the whole collection from submissions. Rows are replaced with upserts
+        (no delete + insert), so a live $inc landing meanwhile cannot make it fail; that
+        increment may still be overwritten, so prefer running it while grading is idle.
+        """
+        totals = {}
+        cursor = db.db["submissions"].find({}, {k: 1 for k in STATS_FIELDS})
+        async for sub in cursor:
+            if "student_username" not in sub or "exam_id" not in sub:
+                continue
+            count, graded, score = _contribution(sub)
+            for key, labels in _stat_keys(sub):
+                t = totals.setdefault(key["_id"], {**labels, "submissions": 0, "graded_count": 0, "total_score": 0})
+                t["submissions"] += count
+                t["graded_count"] += graded
+                t["total_score"] += score
+        rows = [ReplaceOne({"_id": k}, v, upsert=True) for k, v in totals.items()]
+        for i in range(0, len(rows), REBUILD_BATCH_SIZE):
+            await self.collection.bulk_write(rows[i:i + REBUILD_BATCH_SIZE], ordered=False)
+        # Only the kinds maintained here; the collection also holds batch planner statistics
+        await self.collection.delete_many({"kind": {"$in": STATS_KINDS}, "_id": {"$nin": list(totals)}})
+        return len(totals)
+
+    async def ensure_built(self):
+        """
+        Builds the collection once on deployments that predate it (stats are only
+        maintained by increments, so they would stay empty or partial otherwise).
+        The marker document is written only after a successful build, so a crash
+        or error means the next start tries again; concurrent builds are harmless
+        because rebuild() only upserts.
+        """
+        if await self.collection.find_one({"_id": "stats_built"}):
+            return
+        if await self.collection.find_one({"kind": {"$in": STATS_KINDS}}):
+            # Already rebuilt by hand with scripts/rebuild_stats.py
+            count = None
+        else:
+            count = await self.rebuild()
+        await self.collection.update_one(
+            {"_id": "stats_built"},
+            {"$setOnInsert": {"kind": "meta", "built_at": datetime.now()}},
+            upsert=True
+        )
+        if count is not None:
+            print(f"Built {count} stats documents from existing submissions.")
+
+
+stats_service = StatsService()
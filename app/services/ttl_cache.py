@@ -0,0 +1,60 @@
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+def _resolve(value):
+    return value() if callable(value) else value
+
+
+class TTLCache:
+    """
+    Small in-process LRU with an optional per-entry TTL (monotonic clock).
+    `max_entries` and `ttl` take a number or a zero-argument callable (e.g.
+    `lambda: settings.X`), read on each use so setting changes apply right away.
+    `ttl=None` keeps entries until they are evicted. Not thread-safe; meant for
+    the single event loop of a process.
+    """
+
+    def __init__(self, max_entries, ttl=None):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at or None, value)
+
+    def get(self, key, default=None):
+        """The value if present and not expired (marking it recently used), else `default`."""
+        entry = self._entries.get(key, _MISSING)
+        if entry is _MISSING:
+            return default
+        if entry[0] is not None and entry[0] <= time.monotonic():
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def peek(self, key):
+        """(value, fresh) without touching LRU order, expired entries included; None if absent."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        return entry[1], entry[0] is None or entry[0] > time.monotonic()
+
+    def set(self, key, value):
+        ttl = _resolve(self._ttl)
+        self._entries[key] = (None if ttl is None else time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        max_entries = _resolve(self._max_entries)
+        while len(self._entries) > max_entries:
+            self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def items(self) -> list:
+        """Snapshot of (key, value) pairs, oldest first, expired entries included."""
+        return [(key, entry[1]) for key, entry in self._entries.items()]
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,145 @@
+"""
+Standalone grading worker.
+
+Consumes jobs from the `grading_jobs` collection, so grading can run outside the
+web server and scale across cores or machines:
+
+    python -m app.worker                      # one process, GRADING_WORKERS concurrent jobs
+    python -m app.worker --processes 4        # four processes on this machine
+    python -m app.worker --workers 32         # more concurrent jobs per process
+    python -m app.worker --metrics-port 9100  # Prometheus metrics on :9100/metrics (next ports for more processes)
+
+Set GRADING_WORKERS_IN_WEB=false for the web server so it only enqueues.
+Every process leases jobs independently; a job held by a process that dies is
+picked up again once its lease expires.
+
+GEMINI_RPM/GEMINI_TPM are enforced per process: this command's GEMINI_QUOTA_SHARE
+(default 1.0) is split evenly over its --processes. Lower the share when the web
+server or other worker commands grade too, so the shares add up to 1.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+from app.config import settings
+from app.database import db
+from app.services.grading_queue import grading_queue
+from app.services.log_sink import log_sink
+from app.services.metrics import registry, loop_lag_monitor
+from app.services.stats_service import stats_service
+
+
+async def serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Bare-bones HTTP responder for GET /metrics (workers have no web framework)."""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            body, status, content_type = (await registry.render()).encode("utf-8"), "200 OK", "text/plain; version=0.0.4"
+        else:
+            body, status, content_type = b"Not Found\n", "404 Not Found", "text/plain"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def run(workers: int = None, metrics_port: int = 0):
+    db.connect()
+    if not await db.test_connection():
+        print("CRITICAL: Failed to establish a database connection.")
+        db.disconnect()
+        return
+    await db.ensure_indexes()
+    try:
+        await stats_service.ensure_built()
+    except Exception as e:
+        print(f"Stats build failed (run scripts/rebuild_stats.py): {e}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: Ctrl+C arrives as KeyboardInterrupt instead
+            pass
+
+    metrics_server = None
+    if metrics_port:
+        metrics_server = await asyncio.start_server(serve_metrics, host="0.0.0.0", port=metrics_port)
+        print(f"Worker metrics on http://0.0.0.0:{metrics_port}/metrics")
+
+    grading_queue.start(workers)
+    loop_lag_monitor.start()
+    log_sink.start()
+    try:
+        await stop.wait()
+    finally:
+        print("Grading worker shutting down...")
+        await grading_queue.stop()
+        await loop_lag_monitor.stop()
+        await log_sink.stop()
+        if metrics_server:
+            metrics_server.close()
+            await metrics_server.wait_closed()
+        db.disconnect()
+
+
+def run_process(workers: int = None, metrics_port: int = 0):
+    try:
+        asyncio.run(run(workers, metrics_port))
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run grading workers outside the web server.")
+    parser.add_argument("--processes", type=int, default=1, help="worker processes to start on this machine")
+    parser.add_argument("--workers", type=int, default=settings.GRADING_WORKERS, help="concurrent grading jobs per process")
+    parser.add_argument("--metrics-port", type=int, default=settings.WORKER_METRICS_PORT,
+                        help="serve /metrics on this port; process i uses port + i (0 = off)")
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        run_process(args.workers, args.metrics_port)
+        return
+
+    # Each process runs its own Gemini limiter; split this command's share of the quota.
+    # Spawned children read their settings from the environment at import.
+    share = settings.GEMINI_QUOTA_SHARE / args.processes
+    os.environ["GEMINI_QUOTA_SHARE"] = str(share)
+    print(f"Gemini quota per process: {settings.GEMINI_RPM * share:g} RPM, {settings.GEMINI_TPM * share:g} TPM.")
+
+    # Spawn (not fork) so every process creates its own event loop and Mongo client
+    ctx = multiprocessing.get_context("spawn")
+    processes = [
+        ctx.Process(
+            target=run_process,
+            args=(args.workers, args.metrics_port + i if args.metrics_port else 0),
+            name=f"grading-worker-{i}"
+        )
+        for i in range(args.processes)
+    ]
+    for p in processes:
+        p.start()
+    # Forward SIGTERM so each child releases its running jobs before exiting
+    signal.signal(signal.SIGTERM, lambda *_: [p.terminate() for p in processes if p.is_alive()])
+    print(f"Started {len(processes)} grading worker processes.")
+    try:
+        for p in processes:
+            p.join()
+    except KeyboardInterrupt:
+        for p in processes:
+            p.join()
+
+
+if __name__ == "__main__":
+    main()
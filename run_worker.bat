@@ -0,0 +1,7 @@
+@echo off
+echo Starting the grading worker...
+echo Note: set GRADING_WORKERS_IN_WEB=false in .env so the web server only enqueues.
+echo.
+call venv\Scripts\activate
+python -m app.worker
+pause
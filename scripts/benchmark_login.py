@@ -0,0 +1,63 @@
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+# Add project root to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+# Only hashing is measured here; no sessions are issued, so a throwaway signing key is fine
+os.environ.setdefault("SESSION_DEV_RANDOM_SECRET", "true")
+
+from app.services.auth_service import pwd_context, verify_password
+
+async def measure_loop_lag(stop: asyncio.Event, samples: list, interval: float = 0.01):
+    """Records how late the event loop wakes up; large values mean something is blocking it."""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - start - interval)
+
+async def run(mode: str, logins: int, concurrency: int, hashed: str):
+    async def inline_verify():
+        # The old behaviour: bcrypt runs directly on the event loop
+        return pwd_context.verify("password", hashed)
+
+    verify = inline_verify if mode == "inline" else (lambda: verify_password("password", hashed))
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, lag = [], []
+
+    async def login():
+        async with semaphore:
+            start = time.perf_counter()
+            assert await verify()
+            latencies.append(time.perf_counter() - start)
+
+    stop = asyncio.Event()
+    probe = asyncio.create_task(measure_loop_lag(stop, lag))
+    start = time.perf_counter()
+    await asyncio.gather(*(login() for _ in range(logins)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probe
+
+    latencies.sort()
+    print(f"[{mode}] {logins} logins, concurrency {concurrency}")
+    print(f"  throughput : {logins / elapsed:.1f} logins/s")
+    print(f"  latency    : p50 {statistics.median(latencies) * 1000:.0f} ms, p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.0f} ms")
+    print(f"  loop lag   : max {max(lag or [0]) * 1000:.0f} ms (other requests are stalled this long)")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark password verification during a login rush.")
+    parser.add_argument("--logins", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    hashed = pwd_context.hash("password")
+    print(f"bcrypt rounds: {pwd_context.to_dict()['bcrypt__rounds']}")
+    for mode in ("inline", "pool"):
+        await run(mode, args.logins, args.concurrency, hashed)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,250 @@
+"""
+End-to-end benchmark of the exam submission peak.
+
+Seeds N students and one exam, then every virtual student concurrently runs
+login -> GET /exam/{id} -> POST /exam/{id}/submit -> status polling against the
+FastAPI app in-process. Grading uses the offline mock backend, so no quota is used.
+
+    python scripts/benchmark_submission_peak.py --students 200 --concurrency 100
+    python scripts/benchmark_submission_peak.py --db mongo      # use MONGODB_URL (a local/dev database!)
+
+Results are printed and written as JSON (default: bench_output.json) so runs can be
+compared across commits. A student counts as finished once the submission reaches any
+final status (graded, reviewed, partially_graded or grading_failed); the report breaks
+the finished submissions down by status.
+
+Extra dependencies (not in requirements.txt, development only):
+    pip install mongomock-motor      # in-memory Motor client for the default --db mongomock
+It was written against mongomock 4.3 / mongomock-motor 0.0.36. Those versions reject the
+`sort` option pymongo 4.16 passes for bulk UpdateOne, so the script wraps mongomock's
+private BulkOperationBuilder.add_update to drop it (only when that method lacks a `sort`
+parameter). If a mongomock upgrade breaks that shim, use --db mongo.
+"""
+import argparse
+import asyncio
+import inspect
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+# Add project root to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the login -> submit -> graded path.")
+    parser.add_argument("--students", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=100, help="students active at the same time")
+    parser.add_argument("--questions", type=int, default=2)
+    parser.add_argument("--db", choices=["mongomock", "mongo"], default="mongomock",
+                        help="mongomock (in-memory, needs mongomock-motor) or the database in MONGODB_URL")
+    parser.add_argument("--mock-latency-ms", type=float, default=1500.0)
+    parser.add_argument("--mock-error-rate", type=float, default=0.0)
+    parser.add_argument("--mock-malformed-rate", type=float, default=0.0)
+    parser.add_argument("--bcrypt-rounds", type=int, default=4, help="low by default so logins do not dominate")
+    parser.add_argument("--cache", action="store_true", help="keep the grading result cache enabled")
+    parser.add_argument("--poll-interval", type=float, default=2.0)
+    parser.add_argument("--timeout", type=float, default=300.0, help="give up waiting for grading after this many seconds")
+    parser.add_argument("--output", default="bench_output.json")
+    return parser.parse_args()
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+    return {
+        "count": len(values),
+        "p50_ms": round(pick(50) * 1000, 1),
+        "p95_ms": round(pick(95) * 1000, 1),
+        "p99_ms": round(pick(99) * 1000, 1),
+        "max_ms": round(values[-1] * 1000, 1),
+        "mean_ms": round(statistics.mean(values) * 1000, 1)
+    }
+
+
+async def measure_loop_lag(stop: asyncio.Event, samples: list, interval: float = 0.05):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - start - interval)
+
+
+async def run(args):
+    import httpx
+    from bson import ObjectId
+    from app.database import db
+    from app.main import app
+    from app.services.ai_service import ai_service
+    from app.services.auth_service import hash_password
+    from app.services.events import submission_events, FINAL_STATUSES
+    from app.services.grading_queue import grading_queue
+    from app.services.log_sink import log_sink
+
+    if args.db == "mongomock":
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            sys.exit("mongomock-motor is not installed: pip install mongomock-motor (or use --db mongo)")
+        # Private-API shim, see the module docstring: drop the `sort` option for bulk UpdateOne
+        import mongomock.collection
+        add_update = mongomock.collection.BulkOperationBuilder.add_update
+        if "sort" not in inspect.signature(add_update).parameters:
+            mongomock.collection.BulkOperationBuilder.add_update = (
+                lambda self, *a, sort=None, **k: add_update(self, *a, **k)
+            )
+        db.client = AsyncMongoMockClient()
+        db.db = db.client["benchmark"]
+    else:
+        db.connect()
+        if not await db.test_connection():
+            sys.exit("Could not connect to MONGODB_URL")
+    await db.ensure_indexes()
+
+    # Seed
+    run_id = datetime.now().strftime("%Y%m%d%H%M%S")
+    password_hash = await hash_password("password")
+    usernames = [f"bench_{run_id}_{i}" for i in range(args.students)]
+    await db.db["users"].insert_many([
+        {"username": u, "password": password_hash, "role": "student", "enrolled_subjects": ["Benchmark"]}
+        for u in usernames
+    ])
+    exam_id = str((await db.db["exams"].insert_one({
+        "subject": "Benchmark",
+        "title": f"Benchmark exam {run_id}",
+        "description": "Load test",
+        "questions": [
+            {"id": f"q{i+1}", "text": f"Benchmark question {i+1}", "max_score": 10, "answer_key": "key", "rubric": []}
+            for i in range(args.questions)
+        ],
+        "created_by": "benchmark",
+        "is_deleted": False
+    })).inserted_id)
+
+    grading_queue.start()
+    submission_events.start()
+    log_sink.start()
+
+    timings = {"login": [], "get_exam": [], "submit": [], "status_poll": [], "time_to_final": []}
+    failures = {"http": 0, "timeout": 0}
+    outcomes = {}  # final status -> submissions
+    semaphore = asyncio.Semaphore(args.concurrency)
+    transport = httpx.ASGITransport(app=app)
+
+    async def timed(step, coro):
+        start = time.perf_counter()
+        response = await coro
+        timings[step].append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            failures["http"] += 1
+        return response
+
+    async def student(username, i):
+        async with semaphore:
+            async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+                await timed("login", client.post("/login", data={"username": username, "password": "password"}))
+                await timed("get_exam", client.get(f"/exam/{exam_id}"))
+                form = {f"answer_q{q+1}": f"answer {i % 20} for question {q+1}" for q in range(args.questions)}
+                submitted = time.perf_counter()
+                response = await timed("submit", client.post(f"/exam/{exam_id}/submit", data=form))
+                submission_id = response.headers.get("location", "").rsplit("/", 1)[-1]
+                if not submission_id:
+                    failures["http"] += 1
+                    return
+                while time.perf_counter() - submitted < args.timeout:
+                    status = (await timed("status_poll", client.get(f"/api/submission/status/{submission_id}"))).json()
+                    if status.get("status") in FINAL_STATUSES:
+                        timings["time_to_final"].append(time.perf_counter() - submitted)
+                        outcomes[status["status"]] = outcomes.get(status["status"], 0) + 1
+                        return
+                    await asyncio.sleep(args.poll_interval)
+                failures["timeout"] += 1
+
+    lag = []
+    stop = asyncio.Event()
+    probe = asyncio.create_task(measure_loop_lag(stop, lag))
+    started = time.perf_counter()
+    await asyncio.gather(*(student(u, i) for i, u in enumerate(usernames)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe
+    await grading_queue.stop()
+    await submission_events.stop()
+    await log_sink.stop()
+
+    # Clean up seeded data when running against a real database
+    if args.db == "mongo":
+        sub_ids = [str(s["_id"]) for s in await db.db["submissions"].find({"exam_id": exam_id}, {"_id": 1}).to_list(None)]
+        await db.db["grading_jobs"].delete_many({"submission_id": {"$in": sub_ids}})
+        await db.db["submissions"].delete_many({"exam_id": exam_id})
+        await db.db["exams"].delete_one({"_id": ObjectId(exam_id)})
+        await db.db["users"].delete_many({"username": {"$in": usernames}})
+        db.disconnect()
+
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).strip()
+    except Exception:
+        commit = None
+
+    requests_total = sum(len(timings[s]) for s in ("login", "get_exam", "submit", "status_poll"))
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "config": vars(args),
+        "elapsed_s": round(elapsed, 2),
+        "students_finished": len(timings["time_to_final"]),
+        "outcomes": outcomes,
+        "throughput": {
+            "requests_per_s": round(requests_total / elapsed, 1),
+            "submissions_finished_per_s": round(len(timings["time_to_final"]) / elapsed, 2)
+        },
+        "latency": {step: percentiles(values) for step, values in timings.items()},
+        "event_loop_lag": percentiles(lag),
+        "failures": failures,
+        "backend": ai_service.backend.stats() if hasattr(ai_service.backend, "stats") else {}
+    }
+    return report
+
+
+def main():
+    args = parse_args()
+    # Settings are read at import time, so configure the app before importing it
+    os.environ.setdefault("MONGODB_URL", "mongodb://localhost:27017")
+    os.environ.setdefault("DB_NAME", "exam_grading_benchmark")
+    os.environ["GRADING_BACKEND"] = "mock"
+    os.environ["MOCK_LATENCY_MEDIAN_MS"] = str(args.mock_latency_ms)
+    os.environ["MOCK_ERROR_RATE"] = str(args.mock_error_rate)
+    os.environ["MOCK_MALFORMED_RATE"] = str(args.mock_malformed_rate)
+    os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    # Sessions only live for the benchmark process
+    os.environ.setdefault("SESSION_DEV_RANDOM_SECRET", "true")
+    # Benchmark answers repeat, so the cache is off unless explicitly requested
+    os.environ["GRADING_CACHE_ENABLED"] = "true" if args.cache else "false"
+
+    report = asyncio.run(run(args))
+
+    print(f"\n=== Submission peak: {args.students} students, concurrency {args.concurrency} ===")
+    print(f"elapsed {report['elapsed_s']}s, finished {report['students_finished']}/{args.students} {report['outcomes']}, "
+          f"{report['throughput']['requests_per_s']} req/s, {report['throughput']['submissions_finished_per_s']} finished/s")
+    for step, stats in report["latency"].items():
+        if stats["count"]:
+            print(f"  {step:<15} n={stats['count']:<6} p50={stats['p50_ms']:>8}ms p95={stats['p95_ms']:>8}ms p99={stats['p99_ms']:>8}ms")
+    lag = report["event_loop_lag"]
+    if lag["count"]:
+        print(f"  {'event loop lag':<15} p50={lag['p50_ms']}ms p99={lag['p99_ms']}ms max={lag['max_ms']}ms")
+    print(f"  failures: {report['failures']}  backend: {report['backend']}")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
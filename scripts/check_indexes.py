@@ -0,0 +1,50 @@
+import asyncio
+import os
+import sys
+
+# Add project root to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.database import db, INDEXES
+
+async def check_indexes():
+    """Reports registry indexes missing from the database and indexes that are never used."""
+    try:
+        db.connect()
+        print("🔎 Checking indexes against app.database.INDEXES...")
+        missing_total = 0
+
+        for collection, indexes in INDEXES.items():
+            info = await db.db[collection].index_information()
+            existing = {tuple((k, d if isinstance(d, str) else int(d)) for k, d in spec["key"]): name for name, spec in info.items()}
+            expected = {tuple(keys) for keys, _ in indexes}
+
+            print(f"\n[{collection}]")
+            for keys in expected:
+                if keys in existing:
+                    print(f"  ✅ {existing[keys]}")
+                else:
+                    missing_total += 1
+                    print(f"  ❌ MISSING: {list(keys)}")
+
+            for keys, name in existing.items():
+                if name != "_id_" and keys not in expected:
+                    print(f"  ➕ Not in registry: {name}")
+
+            # $indexStats counts operations since the last server restart
+            try:
+                stats = await db.db[collection].aggregate([{"$indexStats": {}}]).to_list(None)
+                for stat in stats:
+                    if stat["name"] != "_id_" and stat["accesses"]["ops"] == 0:
+                        print(f"  💤 Unused since {stat['accesses']['since']:%Y-%m-%d %H:%M}: {stat['name']}")
+            except Exception as e:
+                print(f"  (index usage stats unavailable: {e})")
+
+        print(f"\n{'🎉 All registry indexes exist.' if missing_total == 0 else f'⚠️ {missing_total} index(es) missing. Start the app or call db.ensure_indexes() to create them.'}")
+    except Exception as e:
+        print(f"ERROR: {e}")
+    finally:
+        db.disconnect()
+
+if __name__ == "__main__":
+    asyncio.run(check_indexes())
@@ -7,6 +7,7 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from app.services.ai_service import AIService
 from app.database import db
+from app.services.log_sink import log_sink
 
 async def test_key():
     try:
@@ -27,6 +28,8 @@ async def test_key():
     except Exception as e:
         print(f"ERROR: {e}")
     finally:
+        # ai_logs are buffered; write the entry so scripts/check_ai_logs.py can show it
+        await log_sink.flush()
         db.disconnect()
 
 if __name__ == "__main__":